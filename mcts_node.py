@@ -1,24 +1,42 @@
+from array import array
+from p3_t3 import actions_mask, code_actions
+
+
+def action_string(code):
+    """ Formats an action code as its (R, C, r, c) action, as MCTSNode prints it. """
+    return str(code_actions[code])
 
 
 class MCTSNode:
-    def __init__(self, parent=None, parent_action=None, action_list=[]):
+    untried_priors = None  # The untried actions ranked by move prior, best last; only set when searching with priors.
+    # Action -> symmetry t for children shared with a symmetric position: the child's actions are stored in its
+    # own orientation, and t maps them to this node's. Only set on nodes that have such children.
+    child_symmetries = None
+
+    def __init__(self, parent=None, parent_action=None, action_list=None):
         """ Initializes the tree node for MCTS. The node stores links to other nodes in the tree (parent and child
         nodes), as well as keeps track of the number of wins and total simulations that have visited the node.
 
         Args:
             parent:         The parent node of this node.
             parent_action:  The action taken from the parent node that transitions the state to this node.
-            action_list:    The list of legal actions to be considered at this node.
+            action_list:    The list of legal actions to be considered at this node, or None to have expand_leaf
+                            list them the first time it expands the node.
 
         """
         self.parent = parent                    # Parent node to this node
         self.parent_action = parent_action      # The move that got us to this node - "None" for the root node.
 
         self.child_nodes = {}                   # Action -> MCTSNode dictionary of children
-        self.untried_actions = action_list      # Yet unexplored actions
+        # Yet unexplored actions, as a mask of action codes (see p3_t3.actions_mask). None until they are listed.
+        self.untried_actions = None if action_list is None else actions_mask(action_list)
 
         self.wins = 0                           # Total wins of all paths through this node.
+        self.opponent_wins = 0                  # Total of 1 - win over those paths, the opponent's view of wins.
         self.visits = 0                         # Number of times this node has been visited.
+        self.amaf = None                        # Move code -> [wins, opponent_wins, visits] of later moves, for RAVE.
+        self.proven = None                      # The searching bot's points once the solver proves them: 1, 0 or -1.
+        self.prior = 0.                         # Heuristic score of parent_action, for progressive bias.
 
     def __repr__(self):
         """
@@ -43,3 +61,93 @@ class MCTSNode:
             for child in self.child_nodes.values():
                 string += child.tree_to_string(horizon - 1, indent + 1)
         return string
+
+
+class NodePool:
+    def __init__(self, capacity=200000):
+        """ A preallocated MCTS tree kept as parallel arrays instead of MCTSNode objects. Nodes are indices into
+        the arrays. The children of a node are a contiguous block of slots, reserved the first time the node is
+        expanded: the first expanded[node] of them have been tried, the rest are untried actions.
+
+        Args:
+            capacity:   The number of node slots. Clearing the pool reuses them without reallocating.
+
+        """
+        self.capacity = capacity
+        self.parent = array('i', [-1]) * capacity       # Parent index, -1 for the root
+        self.action = array('b', [-1]) * capacity       # Action code that leads to the node from its parent
+        self.wins = array('d', [0.]) * capacity         # Total wins of all paths through the node
+        self.opponent_wins = array('d', [0.]) * capacity  # Total of 1 - win over those paths
+        self.visits = array('i', [0]) * capacity        # Number of times the node has been visited
+        self.first_child = array('i', [-1]) * capacity  # First slot of the children block, -1 if not reserved
+        self.child_count = array('b', [0]) * capacity   # Number of legal actions at the node
+        self.expanded = array('b', [0]) * capacity      # Number of children tried so far
+        self.size = 0
+
+    def clear(self):
+        """ Empties the pool for a new search. """
+        self.size = 0
+
+    def new_node(self, parent, action):
+        node = self.size
+        if node >= self.capacity:
+            raise MemoryError("node pool is full")
+        self.size += 1
+        self.parent[node] = parent
+        self.action[node] = action
+        self.wins[node] = 0.
+        self.opponent_wins[node] = 0.
+        self.visits[node] = 0
+        self.first_child[node] = -1
+        self.child_count[node] = 0
+        self.expanded[node] = 0
+        return node
+
+    def reserve_children(self, node, actions):
+        """ Reserves the children block of node for the given action codes. Returns False if the pool is full. """
+        if self.size + len(actions) > self.capacity:
+            return False
+        self.first_child[node] = self.size
+        self.child_count[node] = len(actions)
+        for action in actions:
+            self.new_node(node, action)
+        return True
+
+    def pop_untried(self, node, index):
+        """ Marks the untried child with the given index among the untried ones as tried and returns it. """
+        child = self.first_child[node] + self.expanded[node]
+        other = child + index
+        self.action[child], self.action[other] = self.action[other], self.action[child]
+        self.expanded[node] += 1
+        return child
+
+    def untried_count(self, node):
+        return self.child_count[node] - self.expanded[node]
+
+    def children(self, node):
+        """ Returns the range of slots of the tried children of node. """
+        first = self.first_child[node]
+        return range(first, first + self.expanded[node])
+
+    def node_to_string(self, node, action_string=action_string):
+        return ' '.join(["[", action_string(self.action[node]) if self.parent[node] >= 0 else "None",
+                         "Win rate:", "{0:.0f}%".format(100 * self.wins[node] / self.visits[node]),
+                         "Visits:", str(self.visits[node]), "]"])
+
+    def tree_to_string(self, node=0, horizon=1, indent=0, action_string=action_string):
+        """ The MCTSNode.tree_to_string view of the subtree under node.
+
+        Args:
+            node:           The index of the node to start from.
+            horizon:        The cutoff depth for including tree nodes.
+            indent:         How far the node should be indented.
+            action_string:  Formats an action code. Defaults to its (R, C, r, c) action.
+
+        Returns:        A string representing the tree to a given depth.
+
+        """
+        string = ''.join(['| ' for i in range(indent)]) + self.node_to_string(node, action_string) + '\n'
+        if horizon > 0:
+            for child in self.children(node):
+                string += self.tree_to_string(child, horizon - 1, indent + 1, action_string)
+        return string
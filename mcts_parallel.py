@@ -0,0 +1,392 @@
+import multiprocessing
+from multiprocessing import shared_memory, resource_tracker, util
+import random
+from timeit import default_timer as time
+import mcts_vanilla
+from mcts_vanilla import traverse_nodes, expand_leaf, best_child
+from mcts_node import MCTSNode
+from p3_t3 import BoardState
+
+
+WORD = 0xffffffffffffffff
+SLOT_WORDS = 5  # key, check, visits, player 1's wins, player 2's wins
+WIN_SCALE = 1 << 16  # wins are kept as fixed point integers so that fractional results can be added
+attached_tables = {}  # shared memory name -> SharedTable attached by this process
+
+
+class SharedTable(object):
+    """ A fixed-size table of (visits, wins per player) by 64-bit Zobrist key in multiprocessing.shared_memory, for
+    searches in several processes to pool what they learn about each position.
+
+    The slots are grouped in buckets of ways slots and a key can only live in the bucket key % buckets. When its
+    bucket is full, a new key replaces the slot with the fewest visits, so the most searched positions are kept.
+
+    Nothing is locked. Each slot carries a check word, the XOR of its other words, and a slot whose check does
+    not match was torn by a concurrent write and reads as missing. Two processes adding to the same slot at the
+    same time can lose one of the updates, which only costs a little of the shared statistics.
+    """
+
+    def __init__(self, slots=1 << 16, ways=4, name=None):
+        """
+        Args:
+            slots:  The number of entries, rounded up to a whole number of buckets. Each takes 40 bytes.
+            ways:   The number of slots per bucket.
+            name:   The name of an existing table to attach to instead of creating one.
+
+        """
+        self.buckets = -(-slots // ways)
+        self.ways = ways
+        self.slots = self.buckets * ways
+        self.owner = name is None
+        if self.owner:
+            self.memory = shared_memory.SharedMemory(create=True, size=8 * SLOT_WORDS * self.slots)
+        else:
+            self.memory = shared_memory.SharedMemory(name=name)
+            # Attaching registers the segment with this process's resource tracker too, which would report it
+            # leaked and unlink it when the process ends. Only the owner's close() frees it.
+            resource_tracker.unregister(self.memory._name, "shared_memory")
+        self.name = self.memory.name
+        self.words = self.memory.buf.cast('Q')
+        self.counts = self.memory.buf.cast('q')
+        attached_tables[self.name] = self
+        util.Finalize(self, self.close, exitpriority=0)  # detach (and free, in the owner) on the way out if not closed
+
+    def __reduce__(self):
+        # Other processes get the table attached by name, once per process
+        return attach_table, (self.name, self.slots, self.ways)
+
+    def clear(self):
+        self.memory.buf[:] = bytes(self.memory.size)
+
+    def close(self):
+        """ Detaches from the table. The process that created it also frees it. Closing again does nothing. """
+        if attached_tables.pop(self.name, None) is None:
+            return
+        self.words.release()
+        self.counts.release()
+        self.memory.close()
+        if self.owner:
+            # A worker sharing this process's resource tracker took the registration off when it attached
+            resource_tracker.register(self.memory._name, "shared_memory")
+            self.memory.unlink()
+
+    def find(self, key):
+        """ Returns the index of the first word of key's slot, or -1 if key is not in the table. """
+        words = self.words
+        first = key % self.buckets * self.ways * SLOT_WORDS
+        for i in range(first, first + self.ways * SLOT_WORDS, SLOT_WORDS):
+            if words[i] == key and words[i] ^ words[i + 2] ^ words[i + 3] ^ words[i + 4] == words[i + 1]:
+                return i
+        return -1
+
+    def lookup(self, key):
+        """ Returns (visits, player 1's wins, player 2's wins) for key, or None. """
+        i = self.find(key)
+        if i < 0:
+            return None
+        counts = self.counts
+        return counts[i + 2], counts[i + 3] / WIN_SCALE, counts[i + 4] / WIN_SCALE
+
+    def add(self, key, visits, wins1, wins2):
+        """ Adds to the counts of key, making room for it if it is not in the table. """
+        words, counts = self.words, self.counts
+        i = self.find(key)
+        if i < 0:
+            first = key % self.buckets * self.ways * SLOT_WORDS
+            i = min(range(first, first + self.ways * SLOT_WORDS, SLOT_WORDS), key=lambda j: counts[j + 2])
+            counts[i + 2] = counts[i + 3] = counts[i + 4] = 0
+        counts[i + 2] += visits
+        counts[i + 3] += int(wins1 * WIN_SCALE)
+        counts[i + 4] += int(wins2 * WIN_SCALE)
+        words[i] = key
+        words[i + 1] = key ^ words[i + 2] ^ words[i + 3] ^ words[i + 4]
+
+    def add_path(self, keys, outcome):
+        """ Adds one visit with the given points values, as returned by a rollout, to each of the keys. """
+        for key in keys:
+            self.add(key, 1, outcome[1], outcome[2])
+
+    def seed(self, node, key, identity):
+        """ Starts a new MCTSNode from the table's counts for its position. Returns whether there were any. """
+        entry = self.lookup(key)
+        if entry is None or node.visits:
+            return False
+        node.visits = entry[0]
+        node.wins = entry[identity]
+        node.opponent_wins = node.visits - node.wins
+        return True
+
+
+def attach_table(name, slots, ways):
+    table = attached_tables.get(name)
+    if table is None:
+        table = attached_tables[name] = SharedTable(slots, ways, name)
+    return table
+
+
+def root_worker(board, state, rollout, iterations, time_limit, seed, shared_table=None):
+    """ Grows one tree in a worker process, independent of the others but for an optional SharedTable.
+
+    Returns:    The (action, wins, visits) of each root child and the search statistics.
+
+    """
+    random.seed(seed)
+    root_node, stats = mcts_vanilla.search(board, state, rollout, iterations, time_limit=time_limit,
+                                           shared_table=shared_table)
+    return [(action, child.wins, child.visits) for action, child in root_node.child_nodes.items()], stats
+
+
+def merge_root_stats(results):
+    """ Sums the root child wins and visits of several trees. Returns action -> [wins, visits]. """
+    merged = {}
+    for children, stats in results:
+        for action, wins, visits in children:
+            totals = merged.setdefault(action, [0, 0])
+            totals[0] += wins
+            totals[1] += visits
+    return merged
+
+
+def best_merged_action(merged):
+    """ best_child over merged root statistics. """
+    best_winrate = 0
+    best_action = random.choice(list(merged.keys()))
+
+    for action, (wins, visits) in merged.items():
+        winrate = wins / visits
+        if winrate > best_winrate:
+            best_winrate = winrate
+            best_action = action
+
+    return best_action
+
+
+def rollout_worker(board, state, rollout, identity, playouts, seed):
+    """ Runs playouts rollouts from a tuple state. Returns the total of the rollouts' results for identity. """
+    random.seed(seed)
+    sampled_game = BoardState(board, state)
+    return sum(rollout(board, sampled_game)[identity] for playout in range(playouts))
+
+
+def add_virtual_loss(node, count):
+    """ Adds count lost games for the bot to node and its ancestors: count visits, -count wins and 2 * count
+    opponent_wins, as backpropagate_batch would for count playouts worth -1. The bot's win rate through the path
+    drops, so the other leaves of a batch are steered elsewhere on its turns. A negative count takes the losses
+    back. """
+    while node:
+        node.visits += count
+        node.wins -= count
+        node.opponent_wins += 2 * count
+        node = node.parent
+
+
+def backpropagate_batch(node, won, playouts):
+    """ backpropagate for the aggregated result of several playouts from the same leaf.
+
+    Args:
+        node:       A leaf node.
+        won:        The total of the playouts' results for the bot.
+        playouts:   The number of playouts.
+
+    """
+    lost = playouts - won
+    while node:
+        node.visits += playouts
+        node.wins += won
+        node.opponent_wins += lost
+        node = node.parent
+
+
+def search_leaf_parallel(board, state, rollout, batch_size=8, playouts_per_leaf=1, iterations=None,
+                         time_limit=None, pool=None):
+    """ Leaf-parallel MCTS. Each round selects and expands batch_size leaves, holding a virtual loss on each
+    selected path, then evaluates all of them at once and backpropagates the results.
+
+    Args:
+        board:              The game setup.
+        state:              The state of the game.
+        rollout:            The rollout function, taking the board and a BoardState.
+        batch_size:         The number of leaves evaluated together.
+        playouts_per_leaf:  The number of rollouts run from each leaf. Each counts as one visit.
+        iterations:         The number of leaves to add to the tree, or None for no limit.
+        time_limit:         Seconds of wall-clock time to search for, or None for no limit. It is checked between
+                            batches.
+        pool:               Optional multiprocessing.Pool to run the rollouts in. Without one they are run here.
+                            The rollout must be picklable to go to a pool.
+
+    Returns:    The root node and a dict of search statistics.
+
+    """
+    if iterations is None and time_limit is None:
+        raise ValueError("search needs an iteration budget or a time limit")
+    start = time()
+    deadline = None if time_limit is None else start + time_limit
+
+    identity_of_bot = board.current_player(state)
+    root_node = MCTSNode(parent=None, parent_action=None)
+    sampled_game = BoardState(board, state)
+    stats = dict(iterations=0, playouts=0, batches=0)
+
+    while iterations is None or stats['iterations'] < iterations:
+        if deadline is not None and stats['batches'] and time() >= deadline:
+            break
+        size = batch_size if iterations is None else min(batch_size, iterations - stats['iterations'])
+
+        leaves = []
+        jobs = []
+        for leaf in range(size):
+            curr_node, sampled_game = traverse_nodes(root_node, board, sampled_game, identity_of_bot)
+            new_child, sampled_game = expand_leaf(curr_node, board, sampled_game)
+            add_virtual_loss(new_child, playouts_per_leaf)
+            leaves.append(new_child)
+            jobs.append((board, sampled_game.to_state(), rollout, identity_of_bot, playouts_per_leaf,
+                         random.getrandbits(32)))
+
+            # Take back the moves of this playthrough
+            while sampled_game.history:
+                sampled_game.pop()
+
+        if pool is None:
+            results = [rollout_worker(*job) for job in jobs]
+        else:
+            results = pool.starmap(rollout_worker, jobs)
+
+        for leaf, won in zip(leaves, results):
+            add_virtual_loss(leaf, -playouts_per_leaf)
+            backpropagate_batch(leaf, won, playouts_per_leaf)
+        stats['iterations'] += size
+        stats['playouts'] += size * playouts_per_leaf
+        stats['batches'] += 1
+
+    stats['elapsed'] = time() - start
+    return root_node, stats
+
+
+class PoolOwner(object):
+    """ Holds a multiprocessing.Pool of workers processes, started on first use. """
+
+    def __init__(self, workers, persistent):
+        self.workers = workers
+        self.persistent = persistent
+        self.pool = None
+
+    def get_pool(self):
+        if self.pool is None:
+            self.pool = multiprocessing.Pool(self.workers)
+        return self.pool
+
+    def close(self):
+        """ Shuts the worker pool down. It is started again by the next think. """
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+
+class RootParallelPlayer(PoolOwner):
+    """ Root-parallel MCTS: each of workers processes grows its own tree from the same state with a different
+    seed and the same budget, and the root children's wins and visits are summed to pick the move. """
+
+    def __init__(self, workers=4, iterations=None, time_limit=None, rollout=mcts_vanilla.rollout,
+                 persistent=True, shared_slots=0, name="mcts_root_parallel"):
+        """
+        Args:
+            workers:      The number of worker processes.
+            iterations:   The iteration budget of each worker. Defaults to mcts_vanilla.num_nodes when no time
+                          limit is given either.
+            time_limit:   Optional seconds per move. The time spent handing out the work counts against it.
+            rollout:      The rollout function. It must be picklable, i.e. defined at module level.
+            persistent:   Whether to keep the worker pool warm between moves. Otherwise a pool is started and
+                          shut down for every move.
+            shared_slots: The size of a SharedTable for the workers to pool their statistics in, or 0 for none.
+                          It is kept across moves, as its counts stay valid for later positions.
+            name:         The name to print moves under.
+
+        """
+        PoolOwner.__init__(self, workers, persistent)
+        self.iterations = iterations
+        self.time_limit = time_limit
+        self.rollout = rollout
+        self.shared_slots = shared_slots
+        self.shared_table = None
+        self.name = name
+
+    def close(self):
+        PoolOwner.close(self)
+        if self.shared_table is not None:
+            self.shared_table.close()
+            self.shared_table = None
+
+    def think(self, board, state):
+        start = time()
+        iterations = self.iterations
+        if iterations is None and self.time_limit is None:
+            iterations = mcts_vanilla.num_nodes
+
+        pool = self.get_pool()
+        if self.shared_slots and self.shared_table is None:
+            self.shared_table = SharedTable(self.shared_slots)
+        jobs = []
+        for worker in range(self.workers):
+            time_limit = None
+            if self.time_limit is not None:
+                time_limit = max(self.time_limit - (time() - start), 0.)
+            jobs.append(pool.apply_async(root_worker, (board, state, self.rollout, iterations, time_limit,
+                                                       random.getrandbits(32), self.shared_table)))
+        results = [job.get() for job in jobs]
+        if not self.persistent:
+            PoolOwner.close(self)
+
+        if self.shared_table is not None:
+            hits = sum(stats['shared_hits'] for children, stats in results)
+            expansions = sum(stats['expansions'] for children, stats in results)
+            print("%s shared table hits: %d/%d expansions (%.1f%%)" % (self.name, hits, expansions,
+                                                                       100. * hits / max(expansions, 1)))
+
+        action = best_merged_action(merge_root_stats(results))
+        print("%s picking %s (%d iterations over %d workers)" % (
+            self.name, str(action), sum(stats['iterations'] for children, stats in results), self.workers))
+        return action
+
+
+class LeafParallelPlayer(PoolOwner):
+    """ An MCTS bot searching with search_leaf_parallel, the rollouts of each batch spread over a worker pool. """
+
+    def __init__(self, workers=4, batch_size=8, playouts_per_leaf=1, iterations=None, time_limit=None,
+                 rollout=mcts_vanilla.rollout, persistent=True, name="mcts_leaf_parallel"):
+        """
+        Args:
+            workers:            The number of worker processes, or 0 to run the rollouts in this process.
+            batch_size:         The number of leaves evaluated together.
+            playouts_per_leaf:  The number of rollouts run from each leaf.
+            iterations:         The number of leaves to add to the tree. Defaults to mcts_vanilla.num_nodes when no
+                                time limit is given either.
+            time_limit:         Optional seconds per move.
+            rollout:            The rollout function. It must be picklable when workers are used.
+            persistent:         Whether to keep the worker pool warm between moves.
+            name:               The name to print moves under.
+
+        """
+        PoolOwner.__init__(self, workers, persistent)
+        self.batch_size = batch_size
+        self.playouts_per_leaf = playouts_per_leaf
+        self.iterations = iterations
+        self.time_limit = time_limit
+        self.rollout = rollout
+        self.name = name
+
+    def think(self, board, state):
+        iterations = self.iterations
+        if iterations is None and self.time_limit is None:
+            iterations = mcts_vanilla.num_nodes
+
+        pool = self.get_pool() if self.workers else None
+        root_node, stats = search_leaf_parallel(board, state, self.rollout, self.batch_size, self.playouts_per_leaf,
+                                                iterations, self.time_limit, pool)
+        if pool is not None and not self.persistent:
+            self.close()
+
+        action = best_child(root_node).parent_action
+        print("%s picking %s (%d playouts in %d batches)" % (self.name, str(action), stats['playouts'],
+                                                             stats['batches']))
+        return action
@@ -1,25 +1,81 @@
 from mcts_node import MCTSNode
+from p3_t3 import BoardState, action_code, code_actions, move_code, actions_mask, random_code, stabilizer, \
+    transform_code, transform_code_mask, symmetry_product, inverse_symmetry
+import random
 from random import choice
 from math import sqrt, log
 from timeit import default_timer as time
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 num_nodes = 600
 explore_faction = 2.
+check_every = 16  # iterations between clock checks when searching against a time limit
+wide_node = 16  # NodePool nodes with at least this many children are scored with NumPy when it is available
+rave_equivalence = 300  # visits at which a child's own win rate and its RAVE estimate weigh about the same
+
+amaf_keys = (None, {action: move_code(1, action) for action in code_actions},
+             {action: move_code(2, action) for action in code_actions})  # player -> action -> move code
+
+log_table = [float('-inf')]  # log(n) by visit count n, extended as needed
+
 
+def visits_log(n):
+    if n >= len(log_table):
+        log_table.extend(log(i) for i in range(len(log_table), 2 * n + 1))
+    return log_table[n]
 
-def get_urgent_child(node, opponent):
-    def get_UCT(node, node_child, opponent):
-        # uses equation xj + sqrt((2 * ln(n)) / ni) where xj is the win rate of the current node, n is the current node's visits, and nj is the child node's visits
-        # adversarial planning - if the bot is the opponent, the win rate is (1 - bot's win rate) = (1 - node.wins / node.visits)
 
-        xj = node_child.wins / node_child.visits if not opponent else 1 - (node_child.wins / node_child.visits)
-        return xj + (explore_faction * sqrt((2 * log(node.visits) / node_child.visits)))
+def get_urgent_child(node, opponent, solver=False, bias=0.):
+    # uses equation xj + sqrt((2 * ln(n)) / ni) where xj is the win rate of the current node, n is the current node's visits, and nj is the child node's visits
+    # adversarial planning - if the bot is the opponent, the win rate is node.opponent_wins / node.visits. It equals
+    # 1 - node.wins / node.visits in exact arithmetic but may differ from it in the last bit; every selection path
+    # (this one, the node pool and the NumPy scoring) reads opponent_wins, so they agree bit for bit
+    # progressive bias adds bias * prior / (nj + 1), the move heuristic's say fading as the child is visited
+    log_visits = visits_log(node.visits)
 
     urgent_child = None
     prev_bound = float('-inf')
 
     for child in node.child_nodes.values():
-        current_bound = get_UCT(node, child, opponent)
+        if solver and child.proven is not None:  # nothing left to learn under a solved child
+            continue
+        xj = child.wins / child.visits if not opponent else child.opponent_wins / child.visits
+        current_bound = xj + (explore_faction * sqrt((2 * log_visits / child.visits)))
+        if bias:
+            current_bound += bias * child.prior / (child.visits + 1)
+
+        if current_bound > prev_bound:
+            prev_bound = current_bound
+            urgent_child = child
+
+    return urgent_child
+
+
+def get_urgent_rave_child(node, opponent, player, solver=False, bias=0.):
+    # get_urgent_child with xj blended with the node's all-moves-as-first win rate of the child's move, weighted by
+    # beta = sqrt(k / (3 * nj + k)) for k = rave_equivalence, so it fades as the child gathers visits of its own
+    log_visits = visits_log(node.visits)
+    amaf = node.amaf or {}
+    keys = amaf_keys[player]
+
+    urgent_child = None
+    prev_bound = float('-inf')
+
+    for action, child in node.child_nodes.items():
+        if solver and child.proven is not None:
+            continue
+        xj = child.wins / child.visits if not opponent else child.opponent_wins / child.visits
+        move = amaf.get(keys[action])
+        if move is not None:
+            beta = sqrt(rave_equivalence / (3 * child.visits + rave_equivalence))
+            xj += beta * ((move[0] if not opponent else move[1]) / move[2] - xj)
+        current_bound = xj + (explore_faction * sqrt((2 * log_visits / child.visits)))
+        if bias:
+            current_bound += bias * child.prior / (child.visits + 1)
 
         if current_bound > prev_bound:
             prev_bound = current_bound
@@ -28,55 +84,151 @@ def get_urgent_child(node, opponent):
     return urgent_child
 
 
-def traverse_nodes(node, board, state, identity):
+def traverse_nodes(node, board, state, identity, path=None, rave=False, solver=False, bias=0., orientations=None):
     """ Traverses the tree until the end criterion are met.
 
     Args:
         node:       A tree node from which the search is traversing.
         board:      The game setup.
-        state:      The state of the game.
+        state:      The BoardState of the game, moved along in place.
         identity:   The bot's identity, either 'red' or 'blue'.
+        path:       Optional list the traversed nodes are appended to.
+        rave:       Whether to select children with get_urgent_rave_child.
+        solver:     Whether to pass over children whose value is proven. A node whose children are all proven
+                    is proven and returned.
+        bias:       The weight of the children's priors in selection (progressive bias), 0 for none.
+        orientations:   Optional list the orientation of each traversed node is appended to: the symmetry that
+                    maps the node's actions, stored in its own orientation, to the state's. It only differs from
+                    the identity below children shared with a symmetric position (see expand_leaf).
 
     Returns:        A node from which the next stage of the search can proceed. And the updated state
 
     """
-    if node.untried_actions:  # still more actions to try
-        return node, state
-    elif not node.child_nodes:  # no children
-        return node, state
-    else:
-        player = board.current_player(state)  # get current player
-        urgent_child = get_urgent_child(node, False if player == identity else True)  # get the urgent child which is the next node to go to in the tree
-        state = board.next_state(state, urgent_child.parent_action)  # update the board with the move that the node takes
-        
-        return traverse_nodes(urgent_child, board, state, identity)  # recursively call the function until we get to a end criterion is met
-
-    # Hint: return leaf_node
-
+    orientation = 0
+    while True:
+        if path is not None:
+            path.append(node)
+        if orientations is not None:
+            orientations.append(orientation)
+
+        if node.untried_actions:  # still more actions to try
+            return node, state
+        elif not node.child_nodes:  # no children
+            return node, state
 
-def expand_leaf(node, board, state):
+        player = state.current_player()  # get current player
+        if rave:
+            urgent_child = get_urgent_rave_child(node, player != identity, player, solver, bias)
+        else:
+            urgent_child = get_urgent_child(node, False if player == identity else True, solver, bias)  # get the urgent child which is the next node to go to in the tree
+        if urgent_child is None:  # every child is proven, through transpositions proven from another parent
+            best = max if player == identity else min
+            node.proven = best(child.proven for child in node.child_nodes.values())
+            return node, state
+        action = urgent_child.parent_action
+        if urgent_child.parent is not node:  # a transposition first reached from another parent
+            action = next(a for a, child in node.child_nodes.items() if child is urgent_child)
+        if orientation:
+            state.push(code_actions[transform_code(action_code(action), orientation)])
+        else:
+            state.push(action)  # update the board with the move that the node takes
+        if node.child_symmetries is not None and action in node.child_symmetries:
+            orientation = symmetry_product[orientation][node.child_symmetries[action]]
+
+        node = urgent_child  # and keep going until an end criterion is met
+
+
+def ranked_untried(untried, state, orientation=0):
+    """ Returns (prior, tie-break, code) for each action code of the untried mask, scored by
+    BoardState.move_prior and sorted so that pop() gives the best one, ties broken at random. The codes are in
+    the node's orientation, which symmetry orientation maps to the state's. """
+    ranked = []
+    while untried:
+        low = untried & -untried
+        untried ^= low
+        code = low.bit_length() - 1
+        ranked.append((state.move_prior(code_actions[transform_code(code, orientation)]), random.random(), code))
+    ranked.sort()
+    return ranked
+
+
+def expand_leaf(node, board, state, table=None, symmetry_depth=0, priors=False, symmetries=None, orientations=None):
     """ Adds a new leaf to the tree by creating a new child node for the given node.
 
     Args:
         node:   The node for which a child will be added.
         board:  The game setup.
-        state:  The state of the game.
+        state:  The BoardState of the game, moved along in place.
+        table:  Optional transposition table of Zobrist key -> node. A child whose position is already in the
+                table is linked to the existing node instead of a new one.
+        symmetry_depth: Children less than this many moves below the root only get one action out of each set
+                of actions that lead to symmetric positions.
+        priors: Whether to expand the untried action with the best BoardState.move_prior first, and keep its
+                prior on the child for progressive bias. The actions are scored once, on the node's first
+                expansion.
+        symmetries: Optional symmetries of the root position, the identity included, to fold positions they map
+                onto each other into one node. The table then holds BoardState.canonical_key -> (node, s),
+                where s maps the node's position to the one with that key, and a child shared with a
+                symmetric position is linked with the symmetry between their orientations in
+                node.child_symmetries.
+        orientations: With symmetries, traverse_nodes' orientations of the path to node. The new child's is
+                appended.
 
     Returns:    The added child node. And the Updated state
 
     """
-    if not node.untried_actions:  # empty list of untried actions
-        if not node.child_nodes:  # no children
-            return node, state
-        else:  # should be terminal node. Can't have children
-            print("error: node without untried actions and children is not expandable")
+    orientation = orientations[-1] if orientations else 0
+    if node.untried_actions is None:  # first expansion: list the actions now rather than when the node was added
+        if state.is_ended():
+            untried = 0  # the game is over, whatever cells are still free
+        elif len(state.history) < symmetry_depth:
+            untried = actions_mask(state.distinct_actions())  # skip moves symmetric to another one
+        else:
+            untried = state.legal_mask()  # get the set of available actions
+        if orientation:
+            untried = transform_code_mask(untried, inverse_symmetry[orientation])  # in the node's own orientation
+        node.untried_actions = untried
+
+    if not node.untried_actions:  # a terminal node, or one with every action tried: nothing to add
+        return node, state
 
-    next_move = choice(node.untried_actions)  # makes a random choice
-    state = board.next_state(state, next_move)  # updates state with new action
-    available_actions = board.legal_actions(state)  # get the next set of available actions
-    new_child = MCTSNode(parent=node, parent_action=next_move, action_list=available_actions)
+    if priors:
+        if node.untried_priors is None:  # score the actions once, when the node is first expanded
+            node.untried_priors = ranked_untried(node.untried_actions, state, orientation)
+        prior, tie_break, code = node.untried_priors.pop()  # the most promising action first
+    else:
+        code, prior = random_code(node.untried_actions, random), 0.  # makes a random choice
+    node.untried_actions &= ~(1 << code)  # removes the choice from tried choices
+    next_move = code_actions[code]
+    if orientation:
+        state.push(code_actions[transform_code(code, orientation)])
+    else:
+        state.push(next_move)  # updates state with new action
+    if symmetries is not None:
+        key, image = state.canonical_key(symmetries)
+        entry = table.get(key)
+        if entry is not None:  # the same position, or a symmetric one, reached through another move order
+            new_child, to_canonical = entry
+            child_orientation = symmetry_product[inverse_symmetry[image]][to_canonical]
+            link = symmetry_product[inverse_symmetry[orientation]][child_orientation]
+            if link:
+                if node.child_symmetries is None:
+                    node.child_symmetries = {}
+                node.child_symmetries[next_move] = link
+        else:
+            new_child = MCTSNode(parent=node, parent_action=next_move)
+            new_child.prior = prior
+            table[key] = (new_child, symmetry_product[image][orientation])
+            child_orientation = orientation
+        orientations.append(child_orientation)
+    elif table is not None and state.key in table:
+        new_child = table[state.key]  # the same position reached through another move order
+    else:
+        new_child = MCTSNode(parent=node, parent_action=next_move)
+        new_child.prior = prior
+        if table is not None:
+            table[state.key] = new_child
 
-    node.untried_actions.remove(next_move)  # removes the random choice from tried choices
     node.child_nodes[next_move] = new_child  # and declares at that index in child_nodes as the new node
 
     return new_child, state
@@ -84,22 +236,20 @@ def expand_leaf(node, board, state):
     # Hint: return new_node
 
 
-def rollout(board, state):
+def rollout(board, state, moves=None, max_depth=None):
     """ Given the state of the game, the rollout plays out the remainder randomly.
 
     Args:
-        board:  The game setup.
-        state:  The state of the game.
+        board:      The game setup.
+        state:      The BoardState of the game. It is left unchanged.
+        moves:      Optional list the p3_t3.move_code of each move played is appended to.
+        max_depth:  Optional number of moves after which to stop and score the position with p3_t3.static_value.
 
-    Returns: The updated state
+    Returns: The points values of the finished game, or the static values of the position the rollout stopped at
 
     """
 
-    while not board.is_ended(state):
-        rdm_choice = choice(board.legal_actions(state))  # make a random legal choice
-        state = board.next_state(state, rdm_choice)  # update state
-
-    return state  # state should be at the end of the game. Either win or loss
+    return state.playout(random, max_depth, moves, evaluate=True)[0]  # random moves to the end or to max_depth
 
 
 def backpropagate(node, won):
@@ -111,55 +261,527 @@ def backpropagate(node, won):
 
     """
 
-    if node:  # if node == None then we've reached the root node's parent
+    lost = 1 - won  # the opponent's share, summed separately so selection reads it instead of 1 - wins / visits
+
+    while node:  # if node == None then we've reached the root node's parent
         node.visits += 1
         node.wins += won  # won = 1, 0, or -1. These values correspond to a win, draw, or a loss
-        backpropagate(node.parent, won)  # recursively call to go up the tree to the root
+        node.opponent_wins += lost
+        node = node.parent  # go up the tree to the root
 
-    return
 
+def backpropagate_path(path, won):
+    """ Updates the win and visit count of each node on a path from the root. Used with a transposition table,
+    where a node's parent link only records the first way the node was reached.
 
-def think(board, state):
-    """ Performs MCTS by sampling games and calling the appropriate functions to construct the game tree.
+    Args:
+        path:   The nodes visited by this iteration.
+        won:    An indicator of whether the bot won or lost the game.
+
+    """
+    lost = 1 - won
+    for node in path:
+        node.visits += 1
+        node.wins += won
+        node.opponent_wins += lost
+
+
+def update_amaf(path, moves, won, orientations=None):
+    """ Adds the result of a playthrough to the all-moves-as-first statistics of the nodes it went through. Each
+    node counts every later move of the player to move there as if it had been played first.
 
     Args:
-        board:  The game setup.
-        state:  The state of the game.
+        path:   The nodes of the playthrough from the root, one per move.
+        moves:  The move codes of the playthrough from the root, tree moves then rollout moves.
+        won:    An indicator of whether the bot won or lost the game.
+        orientations:   Optional orientation of each node of the path (see traverse_nodes). Moves are counted in
+                the node's own orientation.
 
-    Returns:    The action to be taken.
+    """
+    lost = 1 - won
+    for depth, node in enumerate(path):
+        amaf = node.amaf
+        if amaf is None:
+            amaf = node.amaf = {}
+        mover_moves = moves[depth::2]  # the players alternate, so these are the mover's moves
+        if orientations is not None and orientations[depth]:
+            back = inverse_symmetry[orientations[depth]]
+            mover_moves = [transform_code(move, back) for move in mover_moves]
+        for move in mover_moves:
+            totals = amaf.get(move)
+            if totals is None:
+                amaf[move] = [won, lost, 1]
+            else:
+                totals[0] += won
+                totals[1] += lost
+                totals[2] += 1
+
+
+def prove(path):
+    """ Propagates the proven value of the last node of a path from the root up the path with minimax. A node is
+    proven once one child is proven best for the player to move there, or once all its actions are tried and
+    all its children are proven.
+
+    Args:
+        path:   The nodes from the root, where the bot is to move, to a node whose proven value was just set.
 
     """
-    identity_of_bot = board.current_player(state)
-    root_node = MCTSNode(parent=None, parent_action=None, action_list=board.legal_actions(state))
+    for depth in range(len(path) - 2, -1, -1):
+        node = path[depth]
+        if node.proven is not None:
+            return
+        best = max if depth % 2 == 0 else min  # the bot moves at even depths
+        values = [child.proven for child in node.child_nodes.values()]
+        if best(1, -1) in values:
+            node.proven = best(1, -1)
+        elif not node.untried_actions and None not in values:
+            node.proven = best(values)
+        else:
+            return
+
+
+def best_child(root_node):
+    """ Returns the root child with the best estimated win rate, using the proven value of solved children. A
+    child proven won is always picked: it may have a single visit, since the search stops once the root is
+    proven, and an unproven sibling's sampled win rate can be as high. """
+    for child in root_node.child_nodes.values():
+        if child.proven == 1:
+            return child
+
+    best_winrate = 0
+    rdm_node = choice([child for child in root_node.child_nodes.values() if child.proven != -1] or
+                      list(root_node.child_nodes.values()))
+
+    for child in root_node.child_nodes.values():
+        winrate = child.wins / child.visits if child.proven is None else child.proven
+        if winrate > best_winrate:
+            best_winrate = winrate
+            rdm_node = child
+
+    return rdm_node
+
+
+def decided(root_node, remaining, confidence=None):
+    """ Returns whether best_child(root_node) would still be the same child after remaining more iterations.
+    Every child's win rate is bounded by giving it all the remaining iterations, all won or all lost, and the
+    search is decided once the best child's lowest win rate is above zero and above every other child's highest.
+    Children are only added while the root has untried actions, so there must be none.
+
+    Args:
+        root_node:  The root of the search.
+        remaining:  The number of iterations left.
+        confidence: Optional probability of error to accept instead. The win rates are then bounded with
+                    Hoeffding's inequality, for results in [-1, 1], whatever the number of iterations left.
+
+    Returns:    Whether the search can stop.
+
+    """
+    if root_node.untried_actions:
+        return False
+    if len(root_node.child_nodes) < 2:
+        return True
+
+    bounds = []
+    for child in root_node.child_nodes.values():
+        if child.proven is not None:
+            bounds.append((child.proven, child.proven))
+        elif confidence is None:
+            bounds.append(((child.wins - remaining) / (child.visits + remaining),
+                           (child.wins + remaining) / (child.visits + remaining)))
+        else:
+            winrate = child.wins / child.visits
+            margin = 2 * sqrt(log(1 / confidence) / (2 * child.visits))
+            bounds.append((winrate - margin, winrate + margin))
+
+    bounds.sort()
+    lowest, highest = bounds[-1][0], max(bounds[i][1] for i in range(len(bounds) - 1))
+    return lowest > 0 and lowest > highest
+
+
+def search(board, state, rollout, iterations=None, transpositions=False, symmetry_depth=0, time_limit=None,
+           check_every=check_every, root_node=None, shared_table=None, rave=False, solver=False,
+           early_stop=False, confidence=None, bias=0.):
+    """ Runs rounds of MCTS from state until the iteration budget or the time limit runs out, whichever is first.
+
+    Args:
+        board:          The game setup.
+        state:          The state of the game.
+        rollout:        The rollout function, taking the board and a BoardState.
+        iterations:     The number of nodes to add to the tree, or None for no limit.
+        transpositions: Whether positions reached through different move orders share one node. When the root
+                        position is symmetric, e.g. in the opening, so do positions that its symmetries map
+                        onto each other.
+        symmetry_depth: How many plies below the root to expand only one of each set of symmetric moves.
+        time_limit:     Seconds of wall-clock time to search for, or None for no limit.
+        check_every:    The clock is read every this many iterations, and at least that many iterations are run.
+        root_node:      Optional tree for state to keep growing, e.g. a subtree kept from an earlier search.
+        shared_table:   Optional mcts_parallel.SharedTable of statistics shared with other searches. New nodes below
+                        the root's children start from its counts for their position, and every iteration is added
+                        to it. The root's children are not seeded, so that their visits stay this search's own
+                        when the root statistics of several searches are summed.
+        rave:           Whether to keep all-moves-as-first statistics and blend them into selection. The rollout
+                        must take a list to record its moves in as a third argument.
+        solver:         Whether to prove the values of finished games up the tree with minimax, pass over solved
+                        subtrees, and stop as soon as the root is solved.
+        early_stop:     Whether to stop, every check_every iterations, once the move is decided(). Against a
+                        time limit the iterations left are estimated from the rate so far.
+        confidence:     Optional probability of error for decided() to stop on instead.
+        bias:           The weight of progressive bias: leaves expand their best-scored action by
+                        BoardState.move_prior first, and bias * prior / (visits + 1) is added to each child's UCT
+                        value. 0 turns it off.
+
+    Returns:    The root node and a dict of search statistics.
+
+    """
+    if iterations is None and time_limit is None:
+        raise ValueError("search needs an iteration budget or a time limit")
     start = time()
-    for step in range(num_nodes):
-        # Copy the game for sampling a playthrough
-        sampled_game = state
+    deadline = None if time_limit is None else start + time_limit
+
+    identity_of_bot = board.current_player(state)
+    if root_node is None:
+        root_node = MCTSNode(parent=None, parent_action=None)  # its actions are listed by the first expand_leaf
+    # A single mutable copy of the game for sampling playthroughs
+    sampled_game = BoardState(board, state)
+    table = None
+    symmetries = None  # the root's symmetries, with the identity, when symmetric positions are folded together
+    orientations = None
+    if transpositions:
+        if sampled_game.symmetries():
+            symmetries = (0,) + tuple(sampled_game.symmetries())
+            key, image = sampled_game.canonical_key(symmetries)
+            table = {key: (root_node, image)}
+        else:
+            table = {sampled_game.key: root_node}
+    path = None
+    moves = None
+    stats = dict(iterations=0, expansions=0, transposition_hits=0, symmetry_hits=0, shared_hits=0, proven=0,
+                 saved=0.)
+
+    step = 0
+    while iterations is None or step < iterations:
+        if deadline is not None and step and not step % check_every and time() >= deadline:
+            break
+        if solver and root_node.proven is not None:
+            break
+        if early_stop and step and not step % check_every:
+            remaining = float('inf') if iterations is None else iterations - step
+            if deadline is not None:
+                now = time()
+                remaining = min(remaining, step * (deadline - now) / (now - start))
+            if decided(root_node, remaining, confidence):
+                stats['saved'] = remaining / (step + remaining)
+                break
+        step += 1
 
         # Start at root
         node = root_node
+        if table is not None or rave:
+            path = []
+            table_size = len(table) if table is not None else 0
+        if symmetries is not None:
+            orientations = []
+
+        curr_node, sampled_game = traverse_nodes(node, board, sampled_game, identity_of_bot, path, rave, solver, bias,
+                                                 orientations)
+        new_child, sampled_game = expand_leaf(curr_node, board, sampled_game, table, symmetry_depth, bias != 0,
+                                              symmetries, orientations)
+        if rave:
+            moves = sampled_game.path_moves()
+            outcome = rollout(board, sampled_game, moves)
+        else:
+            outcome = rollout(board, sampled_game)
+        won = outcome[identity_of_bot]
+
+        if new_child is not curr_node:
+            stats['expansions'] += 1
+            if (shared_table is not None and curr_node is not root_node and
+                    shared_table.seed(new_child, sampled_game.key, identity_of_bot)):
+                stats['shared_hits'] += 1
+        if shared_table is not None:
+            shared_table.add_path(sampled_game.path_keys(), outcome)
+        if table is None:
+            backpropagate(new_child, won)
+        else:
+            if new_child is not curr_node:
+                path.append(new_child)
+                if len(table) == table_size:
+                    stats['transposition_hits'] += 1
+                    if orientations is not None and orientations[-1] != orientations[-2]:
+                        stats['symmetry_hits'] += 1  # linked to a symmetric position's node
+            backpropagate_path(path, won)
+        if rave:
+            if table is None and new_child is not curr_node:
+                path.append(new_child)
+            update_amaf(path, moves, won, orientations)
+        if solver:
+            if new_child.proven is None and sampled_game.is_ended():
+                new_child.proven = sampled_game.points_values()[identity_of_bot]
+                stats['proven'] += 1
+            if new_child.proven is not None:
+                # also when the node was proven before: a transposition may have reached it from another parent
+                if path is None:
+                    path = []
+                    while new_child:
+                        path.insert(0, new_child)
+                        new_child = new_child.parent
+                prove(path)
+                path = None
+        stats['iterations'] += 1
+
+        # Take back the moves of this playthrough
+        while sampled_game.history:
+            sampled_game.pop()
+
+    stats['elapsed'] = time() - start
+    return root_node, stats
+
+
+def get_urgent_pool_child(pool, node, opponent, views=None):
+    """ get_urgent_child for a node of a NodePool. Returns the index of the child.
 
-        # Do MCTS - This is all you!
+    Args:
+        pool:       The NodePool.
+        node:       The index of the node.
+        opponent:   Whether the opponent is to move at node.
+        views:      Optional NumPy views of the pool's wins, opponent_wins and visits. Nodes with at least
+                    wide_node children are then scored in one vectorized pass, picking the same child.
 
-        curr_node, sampled_game = traverse_nodes(node, board, sampled_game, identity_of_bot)
-        new_child, sampled_game = expand_leaf(curr_node, board, sampled_game)
-        sampled_game = rollout(board, sampled_game)
+    """
+    wins, opponent_wins, visits = pool.wins, pool.opponent_wins, pool.visits
+    log_visits = visits_log(visits[node])
 
-        won = board.points_values(sampled_game)[identity_of_bot]
+    if views is not None and pool.expanded[node] >= wide_node:
+        first = pool.first_child[node]
+        last = first + pool.expanded[node]
+        child_visits = views[2][first:last]
+        xj = (views[1] if opponent else views[0])[first:last] / child_visits
+        return first + int(np.argmax(xj + (explore_faction * np.sqrt((2 * log_visits / child_visits)))))
 
-        backpropagate(new_child, won)
+    urgent_child = -1
+    prev_bound = float('-inf')
 
-    # Return an action, typically the most frequently used action (from the root) or the action with the best
-    # estimated win rate.
+    for child in pool.children(node):
+        xj = wins[child] / visits[child] if not opponent else opponent_wins[child] / visits[child]
+        current_bound = xj + (explore_faction * sqrt((2 * log_visits / visits[child])))
 
+        if current_bound > prev_bound:
+            prev_bound = current_bound
+            urgent_child = child
+
+    return urgent_child
+
+
+def best_pool_child(pool, node):
+    """ best_child for a node of a NodePool. Returns the index of the child. """
+    children = pool.children(node)
     best_winrate = 0
-    rdm_node = choice(list(root_node.child_nodes.values()))
+    rdm_node = choice(children)
 
-    for child in root_node.child_nodes.values():
-        winrate = child.wins / child.visits
+    for child in children:
+        winrate = pool.wins[child] / pool.visits[child]
         if winrate > best_winrate:
             best_winrate = winrate
             rdm_node = child
 
+    return rdm_node
+
+
+def search_pool(board, state, rollout, pool, iterations=None, time_limit=None, check_every=check_every,
+                vectorize=True):
+    """ The search() loop on a NodePool instead of MCTSNode objects. The pool is cleared first.
+
+    The pool saves memory per node, not time: rollouts dominate an iteration, so iterations per second are the
+    same as search() within measurement noise.
+
+    Args:
+        board:          The game setup.
+        state:          The state of the game.
+        rollout:        The rollout function, taking the board and a BoardState.
+        pool:           The mcts_node.NodePool to build the tree in. The root is node 0.
+        iterations:     The number of iterations to run, or None for no limit.
+        time_limit:     Seconds of wall-clock time to search for, or None for no limit.
+        check_every:    The clock is read every this many iterations.
+        vectorize:      Whether to score wide nodes with NumPy, if it is installed. The tree is the same either way.
+
+    Returns:    The root node index and a dict of search statistics. Its pool_full counts the iterations whose leaf
+                could not be expanded because the pool had no room for its children.
+
+    """
+    if iterations is None and time_limit is None:
+        raise ValueError("search needs an iteration budget or a time limit")
+    start = time()
+    deadline = None if time_limit is None else start + time_limit
+
+    identity_of_bot = board.current_player(state)
+    pool.clear()
+    root_node = pool.new_node(-1, -1)
+    sampled_game = BoardState(board, state)
+    parent, wins, opponent_wins, visits = pool.parent, pool.wins, pool.opponent_wins, pool.visits
+    views = None
+    if vectorize and np is not None:
+        views = (np.frombuffer(wins), np.frombuffer(opponent_wins), np.frombuffer(visits, dtype=np.int32))
+    stats = dict(iterations=0, expansions=0, pool_full=0)
+
+    step = 0
+    while iterations is None or step < iterations:
+        if deadline is not None and step and not step % check_every and time() >= deadline:
+            break
+        step += 1
+
+        # Traverse while every action of the node has been tried
+        node = root_node
+        while pool.first_child[node] >= 0 and pool.expanded[node] and not pool.untried_count(node):
+            node = get_urgent_pool_child(pool, node, sampled_game.player != identity_of_bot, views)
+            sampled_game.push(code_actions[pool.action[node]])
+
+        # Expand one untried action, listing the node's actions on its first expansion (none once the game ended)
+        if pool.first_child[node] < 0:
+            actions = [] if sampled_game.is_ended() else sampled_game.legal_actions()
+            if not pool.reserve_children(node, [action_code(action) for action in actions]):
+                stats['pool_full'] += 1  # the leaf is rolled out from without growing the tree
+        if pool.untried_count(node):
+            node = pool.pop_untried(node, int(random.random() * pool.untried_count(node)))
+            sampled_game.push(code_actions[pool.action[node]])
+            stats['expansions'] += 1
+
+        won = rollout(board, sampled_game)[identity_of_bot]
+        lost = 1 - won
+
+        while node >= 0:
+            visits[node] += 1
+            wins[node] += won
+            opponent_wins[node] += lost
+            node = parent[node]
+        stats['iterations'] += 1
+
+        # Take back the moves of this playthrough
+        while sampled_game.history:
+            sampled_game.pop()
+
+    stats['elapsed'] = time() - start
+    stats['nodes'] = pool.size
+    return root_node, stats
+
+
+def report_transpositions(name, stats):
+    print("%s transposition hits: %d/%d expansions (%.1f%%), %d of them symmetric" % (
+        name, stats['transposition_hits'], stats['expansions'],
+        100. * stats['transposition_hits'] / max(stats['expansions'], 1), stats['symmetry_hits']))
+
+
+def report_early_stop(name, stats):
+    print("%s stopped after %d iterations, saving %.1f%% of the budget" % (
+        name, stats['iterations'], 100. * stats['saved']))
+
+
+def report_pool_full(name, stats):
+    print("%s node pool full: %d/%d iterations did not grow the tree (%d nodes)" % (
+        name, stats['pool_full'], stats['iterations'], stats['nodes']))
+
+
+def think(board, state, transpositions=False, symmetry_depth=0, iterations=None, time_limit=None, node_pool=None,
+          rave=False, solver=False, early_stop=False, confidence=None, bias=0.):
+    """ Performs MCTS by sampling games and calling the appropriate functions to construct the game tree.
+
+    Args:
+        board:          The game setup.
+        state:          The state of the game.
+        transpositions: Whether to share nodes between move orders reaching the same position.
+        symmetry_depth: How many plies below the root to skip moves symmetric to another one.
+        iterations:     Iteration budget. Defaults to num_nodes when no time limit is given either.
+        time_limit:     Optional seconds per move. The best move found so far is returned when it runs out.
+        node_pool:      Optional mcts_node.NodePool to search in instead of MCTSNode objects. None of the
+                        options below it, transpositions or symmetry_depth are supported there, and combining
+                        them with a pool raises ValueError.
+        rave:           Whether to blend all-moves-as-first statistics into selection.
+        solver:         Whether to prove won and lost positions and stop once the move is proven.
+        early_stop:     Whether to stop once the remaining budget cannot change the move.
+        confidence:     Optional probability of error to stop early on instead, see decided().
+        bias:           The weight of the move heuristic in selection (progressive bias), 0 for none.
+
+    Returns:    The action to be taken.
+
+    """
+    if iterations is None and time_limit is None:
+        iterations = num_nodes
+
+    if node_pool is not None:
+        unsupported = [name for name, value in (('transpositions', transpositions), ('symmetry_depth', symmetry_depth),
+                                                ('rave', rave), ('solver', solver), ('early_stop', early_stop),
+                                                ('confidence', confidence is not None), ('bias', bias)) if value]
+        if unsupported:
+            raise ValueError("node_pool searches do not support " + ", ".join(unsupported))
+        root_node, stats = search_pool(board, state, rollout, node_pool, iterations, time_limit)
+        if stats['pool_full']:
+            report_pool_full("mcts_vanilla", stats)
+        action = code_actions[node_pool.action[best_pool_child(node_pool, root_node)]]
+        print("mcts_vanilla picking %s" % (str(action)))
+        return action
+    root_node, stats = search(board, state, rollout, iterations, transpositions, symmetry_depth, time_limit,
+                              rave=rave, solver=solver, early_stop=early_stop, confidence=confidence, bias=bias)
+    if transpositions:
+        report_transpositions("mcts_vanilla", stats)
+    if early_stop:
+        report_early_stop("mcts_vanilla", stats)
+
+    # Return an action, typically the most frequently used action (from the root) or the action with the best
+    # estimated win rate.
+    rdm_node = best_child(root_node)
+
     print("mcts_vanilla picking %s" % (str(rdm_node.parent_action)))
     return rdm_node.parent_action
+
+
+class MCTSPlayer(object):
+    """ An MCTS bot that keeps its tree between moves. After our move and the opponent's reply, the search
+    continues from the matching grandchild of the previous root if it was expanded, and from a fresh root
+    otherwise. Its think method can be used wherever a think function is expected.
+    """
+
+    def __init__(self, rollout=rollout, iterations=None, time_limit=None, transpositions=False, symmetry_depth=0,
+                 check_every=check_every, solver=False, bias=0., name="mcts_vanilla"):
+        self.rollout = rollout
+        self.iterations = iterations
+        self.time_limit = time_limit
+        self.transpositions = transpositions
+        self.symmetry_depth = symmetry_depth
+        self.check_every = check_every
+        self.solver = solver
+        self.bias = bias
+        self.name = name
+        self.trees = {}  # player -> (node after our last move, state after our last move)
+
+    def reroot(self, board, state):
+        """ Returns the kept node for state, detached from its parent, or None if the tree did not reach it. """
+        node, our_state = self.trees.pop(board.current_player(state), (None, None))
+        if node is None:
+            return None
+
+        for action, child in node.child_nodes.items():
+            if node.child_symmetries is not None and action in node.child_symmetries:
+                continue  # a symmetric position's node, whose actions are not in this state's orientation
+            if board.next_state(our_state, action) == state:
+                child.parent = None
+                return child
+        return None
+
+    def think(self, board, state):
+        iterations = self.iterations
+        if iterations is None and self.time_limit is None:
+            iterations = num_nodes
+
+        root_node = self.reroot(board, state)
+        carried_visits = root_node.visits if root_node is not None else 0
+        root_node, stats = search(board, state, self.rollout, iterations, self.transpositions,
+                                  self.symmetry_depth, self.time_limit, self.check_every, root_node,
+                                  solver=self.solver, bias=self.bias)
+        if self.transpositions:
+            report_transpositions(self.name, stats)
+
+        rdm_node = best_child(root_node)
+        rdm_node.parent = None  # let the rest of the tree go
+        self.trees[board.current_player(state)] = (rdm_node, board.next_state(state, rdm_node.parent_action))
+
+        print("%s picking %s (%d visits carried over)" % (self.name, str(rdm_node.parent_action), carried_visits))
+        return rdm_node.parent_action
@@ -0,0 +1,149 @@
+import numpy as np
+import p3_t3
+
+UNCONSTRAINED = p3_t3.UNCONSTRAINED
+
+has_line = np.array(p3_t3.has_line, dtype=bool)
+is_full = np.array(p3_t3.is_full, dtype=bool)
+bit_count = np.array(p3_t3.bit_count, dtype=np.int64)
+
+# kth_cell[free, k] is the index of the k-th set bit of the 9-bit mask free.
+kth_cell = np.zeros((0x200, 9), dtype=np.int64)
+for free, cells in enumerate(p3_t3.cell_table):
+    kth_cell[free, :len(cells)] = cells
+
+board_bits = np.array([1 << board for board in range(9)], dtype=np.uint16)
+
+
+class BatchBoard(object):
+    """ N games of p3_t3.Board played in lockstep. The games are held as NumPy uint16 arrays:
+
+        pieces:     (N, 18) sub-board masks, in the order of the tuple state.
+        boards:     (N, 2) big-board masks of player 1 and player 2.
+        constraint: (N,) index 3 * R + C of the required board, or UNCONSTRAINED.
+        player:     (N,) player number to move.
+
+    Actions are cell codes 9 * (3 * R + C) + 3 * r + c.
+    """
+
+    def __init__(self, pieces, boards, constraint, player):
+        self.pieces = pieces
+        self.boards = boards
+        self.constraint = constraint
+        self.player = player
+
+    @classmethod
+    def starting(cls, n):
+        return cls(np.zeros((n, 18), dtype=np.uint16),
+                   np.zeros((n, 2), dtype=np.uint16),
+                   np.full(n, UNCONSTRAINED, dtype=np.uint16),
+                   np.ones(n, dtype=np.uint16))
+
+    @classmethod
+    def from_states(cls, states):
+        """ Builds a batch from a list of p3_t3.Board tuple states. """
+        batch = cls.starting(len(states))
+        for i, state in enumerate(states):
+            batch.pieces[i] = state[:18]
+            batch.boards[i] = state[18:20]
+            if state[20] is not None:
+                batch.constraint[i] = 3 * state[20] + state[21]
+            batch.player[i] = state[22]
+        return batch
+
+    def to_states(self):
+        """ Returns the games as a list of p3_t3.Board tuple states. """
+        states = []
+        for i in range(len(self)):
+            constraint = int(self.constraint[i])
+            if constraint == UNCONSTRAINED:
+                R, C = None, None
+            else:
+                R, C = divmod(constraint, 3)
+            states.append(tuple(int(x) for x in self.pieces[i]) +
+                          tuple(int(x) for x in self.boards[i]) +
+                          (R, C, int(self.player[i])))
+        return states
+
+    def __len__(self):
+        return len(self.player)
+
+    def is_ended(self):
+        b1, b2 = self.boards[:, 0], self.boards[:, 1]
+        return has_line[b1 & ~b2] | has_line[b2 & ~b1] | is_full[b1 | b2]
+
+    def points_values(self):
+        """ Returns player 1's points for each game: 1, -1 or 0, and 0 for unfinished games. """
+        b1, b2 = self.boards[:, 0], self.boards[:, 1]
+        points = np.zeros(len(self), dtype=np.int64)
+        points[has_line[b2 & ~b1]] = -1
+        points[has_line[b1 & ~b2]] = 1
+        return points
+
+    def owned_boxes(self):
+        """ Returns the (N, 2) counts of boxes owned by player 1 and player 2. """
+        b1, b2 = self.boards[:, 0], self.boards[:, 1]
+        return np.stack([bit_count[b1 & ~b2], bit_count[b2 & ~b1]], axis=1)
+
+    def legal_masks(self):
+        """ Returns the (N, 9) free-cell masks of each sub-board, zero where a game may not play. """
+        free = 0x1ff & ~(self.pieces[:, 0::2] | self.pieces[:, 1::2])
+        finished = self.boards[:, 0] | self.boards[:, 1]
+        allowed = (finished[:, None] & board_bits) == 0
+        constrained = self.constraint != UNCONSTRAINED
+        allowed[constrained] &= np.arange(9) == self.constraint[constrained, None]
+        allowed &= ~self.is_ended()[:, None]
+        return np.where(allowed, free, 0).astype(np.uint16)
+
+    def sample_actions(self, rng, uniform=None):
+        """ Picks a uniformly random legal action for each game, -1 for finished games.
+
+        Args:
+            rng:        A numpy.random.Generator.
+            uniform:    Optional (N,) draws in [0, 1) to use instead of rng. The k-th move is picked as in
+                        p3_t3.Board.legal_action(state, int(uniform * count)).
+
+        """
+        masks = self.legal_masks()
+        counts = bit_count[masks]
+        totals = counts.sum(axis=1)
+        if uniform is None:
+            uniform = rng.random(len(self))
+        k = (uniform * totals).astype(np.int64)
+
+        ends = np.cumsum(counts, axis=1)
+        board = (ends <= k[:, None]).sum(axis=1)
+        board = np.minimum(board, 8)
+        rows = np.arange(len(self))
+        k -= ends[rows, board] - counts[rows, board]
+        actions = 9 * board + kth_cell[masks[rows, board], np.minimum(k, 8)]
+        return np.where(totals > 0, actions, -1)
+
+    def next_state(self, actions):
+        """ Plays one action per game in place. Games given a negative action are left untouched. """
+        rows = np.flatnonzero(actions >= 0)
+        actions = actions[rows]
+        board, cell = actions // 9, actions % 9
+        player = self.player[rows].astype(np.int64)
+        index = 2 * board + player - 1
+
+        self.pieces[rows, index] |= (1 << cell).astype(np.uint16)
+        won = has_line[self.pieces[rows, index]]
+        full = ~won & is_full[self.pieces[rows, 2 * board] | self.pieces[rows, 2 * board + 1]]
+        bit = board_bits[board]
+        self.boards[rows[won], player[won] - 1] |= bit[won]
+        self.boards[rows[full], 0] |= bit[full]
+        self.boards[rows[full], 1] |= bit[full]
+
+        finished = self.boards[rows, 0] | self.boards[rows, 1]
+        closed = (finished >> cell.astype(np.uint16)) & 1
+        self.constraint[rows] = np.where(closed, UNCONSTRAINED, cell)
+        self.player[rows] = 3 - player
+
+    def playout(self, rng):
+        """ Plays every game to the end with random moves. Returns player 1's points_values per game. """
+        while True:
+            actions = self.sample_actions(rng)
+            if (actions < 0).all():
+                return self.points_values()
+            self.next_state(actions)
@@ -0,0 +1,380 @@
+import sys
+import random
+from timeit import default_timer as time
+import p3_t3
+import tracemalloc
+import mcts_vanilla
+import mcts_node
+import p3_solver
+
+try:
+    import numpy as np
+    import p3_batch
+except ImportError:
+    np = p3_batch = None
+
+
+def random_playouts(board, rounds, rng):
+    """ Plays rounds random games to the end through the public Board API. """
+    state0 = board.starting_state()
+    for i in range(rounds):
+        state = state0
+        while not board.is_ended(state):
+            state = board.next_state(state, rng.choice(board.legal_actions(state)))
+        board.points_values(state)
+
+
+def indexed_playouts(board, rounds, rng):
+    """ Plays rounds random games, picking each move by index instead of from a list. """
+    state0 = board.starting_state()
+    for i in range(rounds):
+        state = state0
+        while not board.is_ended(state):
+            k = rng.randrange(board.legal_action_count(state))
+            state = board.next_state(state, board.legal_action(state, k))
+        board.points_values(state)
+
+
+def fused_playouts(board, rounds, rng):
+    """ Plays rounds random games with Board.playout. """
+    state0 = board.starting_state()
+    for i in range(rounds):
+        board.playout(state0, rng)
+
+
+def cutoff_playouts(board, rounds, rng):
+    """ Plays rounds random games for 20 moves with Board.playout, scoring unfinished ones with static_value. """
+    state0 = board.starting_state()
+    for i in range(rounds):
+        board.playout(state0, rng, 20, evaluate=True)
+
+
+def batch_playouts(board, rounds, rng):
+    """ Plays rounds random games in lockstep with p3_batch.BatchBoard. """
+    batch = p3_batch.BatchBoard.starting(rounds)
+    batch.playout(np.random.default_rng(rng.randrange(1 << 32)))
+
+
+def batch_check(board, rounds, rng):
+    """ Plays rounds random games with both BatchBoard and the scalar board, feeding them the same random draws,
+    and checks that every intermediate state and result agrees. """
+    batch = p3_batch.BatchBoard.starting(rounds)
+    states = [board.starting_state()] * rounds
+    while True:
+        uniform = np.array([rng.random() for i in range(rounds)])
+        actions = batch.sample_actions(None, uniform)
+        ended, masks = batch.is_ended(), batch.legal_masks()
+        for i, state in enumerate(states):
+            assert ended[i] == board.is_ended(state)
+            if ended[i]:
+                assert actions[i] < 0
+                continue
+            assert list(masks[i]) == [board.free_cells(state, b) if b in board.open_boards(state) else 0
+                                      for b in range(9)]
+            action = board.legal_action(state, int(uniform[i] * board.legal_action_count(state)))
+            R, C, r, c = action
+            assert actions[i] == 9 * (3 * R + C) + 3 * r + c
+            states[i] = board.next_state(state, action)
+        if (actions < 0).all():
+            break
+        batch.next_state(actions)
+        assert batch.to_states() == states
+
+    points = batch.points_values()
+    for i, state in enumerate(states):
+        assert points[i] == board.points_values(state)[1]
+
+
+def packed_check(board, rounds, rng):
+    """ Plays rounds random games on both the tuple Board and PackedBoard, and checks that every intermediate state
+    and every query on it agrees. """
+    packed_board = p3_t3.PackedBoard()
+    for i in range(rounds):
+        state, packed = board.starting_state(), packed_board.starting_state()
+        while True:
+            assert packed_board.to_tuple(packed) == state
+            assert packed_board.from_tuple(state) == packed
+            assert packed_board.is_ended(packed) == board.is_ended(state)
+            assert packed_board.current_player(packed) == board.current_player(state)
+            assert packed_board.bitmasks(packed) == board.bitmasks(state)
+            assert packed_board.owned_boxes(packed) == board.owned_boxes(state)
+            if board.is_ended(state):
+                break
+            actions = board.legal_actions(state)
+            assert sorted(packed_board.legal_actions(packed)) == sorted(actions)
+            action = rng.choice(actions)
+            state, packed = board.next_state(state, action), packed_board.next_state(packed, action)
+        assert packed_board.points_values(packed) == board.points_values(state)
+
+
+def push_pop_check(board, rounds, rng):
+    """ Plays rounds random games with BoardState.push, checking each position against Board.next_state, then takes
+    every move back with pop and checks that each earlier position is restored exactly. """
+    for i in range(rounds):
+        state = board.starting_state()
+        sampled_game = p3_t3.BoardState(board, state)
+        seen = []
+        while not board.is_ended(state):
+            seen.append((list(sampled_game.pieces), sampled_game.b1, sampled_game.b2, sampled_game.constraint,
+                         sampled_game.player, sampled_game.key))
+            action = rng.choice(sampled_game.legal_actions())
+            sampled_game.push(action)
+            state = board.next_state(state, action)
+            assert sampled_game.to_state() == state
+            assert sampled_game.is_ended() == board.is_ended(state)
+        assert sampled_game.points_values() == board.points_values(state)
+
+        while seen:
+            sampled_game.pop()
+            assert (sampled_game.pieces, sampled_game.b1, sampled_game.b2, sampled_game.constraint,
+                    sampled_game.player, sampled_game.key) == seen.pop()
+        assert not sampled_game.history
+
+
+def zobrist_check(board, rounds, rng):
+    """ Plays rounds random games, checking at every move that the Zobrist keys kept incrementally by
+    Board.next_state_key and by BoardState.push equal Board.zobrist computed from scratch. """
+    for i in range(rounds):
+        state = board.starting_state()
+        key = board.zobrist(state)
+        sampled_game = p3_t3.BoardState(board, state)
+        assert sampled_game.key == key
+        while not board.is_ended(state):
+            action = rng.choice(board.legal_actions(state))
+            state, key = board.next_state_key(state, key, action)
+            sampled_game.push(action)
+            assert key == board.zobrist(state)
+            assert sampled_game.key == key
+
+
+def symmetry_check(board, rounds, rng):
+    """ Checks the symmetry tables on the positions of rounds // 20 random games: every symmetry commutes with
+    next_state, symmetry_product and inverse_symmetry compose as they should, the images of a position share its
+    canonical state and canonical key, and the symmetries() of a position leave it unchanged. """
+    everything = list(range(8))
+    for i in range(rounds // 20):
+        state = board.starting_state()
+        while not board.is_ended(state):
+            canonical = board.canonical(state)[0]
+            key = p3_t3.BoardState(board, state).canonical_key(everything)[0]
+            action = rng.choice(board.legal_actions(state))
+            after = board.next_state(state, action)
+            for s in range(8):
+                image = board.transform(state, s)
+                moved = p3_t3.transform_action(action, s)
+                assert p3_t3.transform_code(p3_t3.action_code(action), s) == p3_t3.action_code(moved)
+                assert board.transform(after, s) == board.next_state(image, moved)
+                assert sorted(board.legal_actions(image)) == sorted(p3_t3.transform_action(a, s)
+                                                                     for a in board.legal_actions(state))
+                assert board.canonical(image)[0] == canonical
+                assert p3_t3.BoardState(board, image).canonical_key(everything)[0] == key
+                assert board.transform(image, p3_t3.inverse_symmetry[s]) == state
+                t = rng.randrange(8)
+                assert board.transform(board.transform(state, t), s) == board.transform(
+                    state, p3_t3.symmetry_product[s][t])
+            for s in board.symmetries(state):
+                assert board.transform(state, s) == state
+            state = after
+
+
+def random_position(board, rng, moves):
+    """ Returns the position after up to moves random moves from the start, stopping early if the game ends. """
+    state = board.starting_state()
+    for i in range(moves):
+        if board.is_ended(state):
+            break
+        state = board.next_state(state, rng.choice(board.legal_actions(state)))
+    return state
+
+
+def minimax(board, state):
+    """ The points of the player to move in state under perfect play, by plain exhaustive search. """
+    if board.is_ended(state):
+        return board.points_values(state)[board.current_player(state)]
+    return max(-minimax(board, board.next_state(state, action)) for action in board.legal_actions(state))
+
+
+def solver_check(board, rounds, rng):
+    """ Plays rounds // 20 random games until at most 10 open cells are left, and checks that p3_solver.Solver
+    values the position as plain exhaustive search does. """
+    solver = p3_solver.Solver(max_nodes=1 << 22)
+    for i in range(rounds // 20):
+        state = board.starting_state()
+        sampled_game = p3_t3.BoardState(board, state)
+        while not board.is_ended(state) and p3_solver.open_cells(sampled_game) > 10:
+            action = rng.choice(board.legal_actions(state))
+            state = board.next_state(state, action)
+            sampled_game.push(action)
+        points = solver.solve(sampled_game)
+        assert points is not None
+        assert points[board.current_player(state)] == minimax(board, state)
+        assert sampled_game.to_state() == state
+
+
+def solver_move_check(board, rounds, rng):
+    """ Runs rounds // 20 mcts_vanilla searches with the solver from late positions of random games, and checks
+    that when the root is proven won the move picked is one that p3_solver.Solver proves wins. """
+    random.seed(rng.random())
+    solver = p3_solver.Solver(max_nodes=1 << 22)
+    for i in range(rounds // 20):
+        state = random_position(board, rng, rng.randrange(40, 60))
+        if board.is_ended(state):
+            continue
+        root_node, stats = mcts_vanilla.search(board, state, mcts_vanilla.rollout, 600, solver=True)
+        if root_node.proven != 1:
+            continue
+        child = mcts_vanilla.best_child(root_node)
+        assert child.proven == 1
+        after = p3_t3.BoardState(board, board.next_state(state, child.parent_action))
+        points = solver.solve(after)
+        assert points is None or points[board.current_player(state)] == 1
+
+
+def mcts_iterations(board, rounds, rng):
+    """ Runs one mcts_vanilla search of rounds iterations from the starting state. """
+    random.seed(rng.random())
+    mcts_vanilla.num_nodes = rounds
+    mcts_vanilla.think(board, board.starting_state())
+
+
+def mcts_pool_iterations(board, rounds, rng):
+    """ Runs one mcts_vanilla search of rounds iterations from the starting state in a NodePool. """
+    random.seed(rng.random())
+    mcts_vanilla.search_pool(board, board.starting_state(), mcts_vanilla.rollout, node_pool, rounds)
+
+
+def tree_memory(board, rounds, rng):
+    """ Prints the memory per tree node of MCTSNode objects and of a NodePool after a search of rounds iterations. """
+    random.seed(rng.random())
+    tracemalloc.start()
+    root_node, stats = mcts_vanilla.search(board, board.starting_state(), mcts_vanilla.rollout, rounds)
+    used = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    print("MCTSNode: %d nodes, %.0f bytes/node" % (stats['expansions'] + 1, used / (stats['expansions'] + 1)))
+
+    root_node, stats = mcts_vanilla.search_pool(board, board.starting_state(), mcts_vanilla.rollout, node_pool, rounds)
+    slot = sum(getattr(node_pool, name).itemsize
+               for name in ('parent', 'action', 'wins', 'opponent_wins', 'visits', 'first_child', 'child_count', 'expanded'))
+    print("NodePool: %d nodes in %d slots, %.0f bytes/node" % (
+        stats['expansions'] + 1, node_pool.size, slot * node_pool.size / (stats['expansions'] + 1)))
+
+
+def selection_depths(board, rounds, rng):
+    """ Prints the cost of one selection and backpropagation pass down a chain of tree nodes 10 to 60 deep. """
+    while True:
+        state = board.starting_state()
+        actions = []
+        while not board.is_ended(state):
+            actions.append(rng.choice(board.legal_actions(state)))
+            state = board.next_state(state, actions[-1])
+        if len(actions) > 60:
+            break
+
+    for depth in (10, 20, 30, 40, 50, 60):
+        root_node = node = mcts_node.MCTSNode(action_list=[])
+        for action in actions[:depth]:
+            child = mcts_node.MCTSNode(parent=node, parent_action=action, action_list=[])
+            node.child_nodes[action] = child
+            node = child
+        leaf = node
+        mcts_vanilla.backpropagate(leaf, 0)
+
+        # Best of 5 batches, to keep other load on the machine out of the numbers
+        sampled_game = p3_t3.BoardState(board, board.starting_state())
+        best = float('inf')
+        for batch in range(5):
+            start = time()
+            for i in range(rounds // 5):
+                node, sampled_game = mcts_vanilla.traverse_nodes(root_node, board, sampled_game, 1)
+                mcts_vanilla.backpropagate(node, 0)
+                while sampled_game.history:
+                    sampled_game.pop()
+            best = min(best, (time() - start) / (rounds // 5))
+        assert node is leaf
+        print("depth %2d: %6.1f usec/iteration" % (depth, 1e6 * best))
+
+
+def uct_selection(board, rounds, rng):
+    """ Prints the cost of picking the UCT child of a fully expanded node with 81 children. """
+    stats = [(rng.randrange(-20, 20), rng.randrange(20, 40)) for i in range(81)]
+    root_node = mcts_node.MCTSNode(action_list=[])
+    for i, (wins, visits) in enumerate(stats):
+        child = mcts_node.MCTSNode(parent=root_node, parent_action=i, action_list=[])
+        child.wins, child.opponent_wins, child.visits = wins, visits - wins, visits
+        root_node.child_nodes[i] = child
+        root_node.visits += visits
+
+    start = time()
+    for i in range(rounds):
+        mcts_vanilla.get_urgent_child(root_node, i % 2)
+    print("MCTSNode:          %6.1f usec/selection" % (1e6 * (time() - start) / rounds))
+
+    pool = node_pool
+    pool.clear()
+    pool.new_node(-1, -1)
+    pool.reserve_children(0, list(range(81)))
+    for i, (wins, visits) in enumerate(stats):
+        pool.pop_untried(0, 0)
+        pool.wins[i + 1], pool.opponent_wins[i + 1], pool.visits[i + 1] = wins, visits - wins, visits
+    pool.visits[0] = root_node.visits
+
+    views = None
+    if np is not None:
+        views = (np.frombuffer(pool.wins), np.frombuffer(pool.opponent_wins),
+                 np.frombuffer(pool.visits, dtype=np.int32))
+    for name, arrays in (("NodePool:", None), ("NodePool (NumPy):", views)):
+        start = time()
+        for i in range(rounds):
+            mcts_vanilla.get_urgent_pool_child(pool, 0, i % 2, arrays)
+        print("%-18s %6.1f usec/selection" % (name, 1e6 * (time() - start) / rounds))
+
+
+def report(name, func, board, rounds):
+    rng = random.Random(0)
+    start = time()
+    func(board, rounds, rng)
+    elapsed = time() - start
+    print("%-24s %8d playouts %8.3f seconds %10.1f playouts/sec" % (name, rounds, elapsed, rounds / elapsed))
+
+
+benchmarks = dict(
+    playouts=(random_playouts, p3_t3.Board()),
+    packed_playouts=(random_playouts, p3_t3.PackedBoard()),
+    indexed_playouts=(indexed_playouts, p3_t3.Board()),
+    packed_indexed_playouts=(indexed_playouts, p3_t3.PackedBoard()),
+    fused_playouts=(fused_playouts, p3_t3.Board()),
+    packed_fused_playouts=(fused_playouts, p3_t3.PackedBoard()),
+    cutoff_playouts=(cutoff_playouts, p3_t3.Board()),
+    mcts_iterations=(mcts_iterations, p3_t3.Board()),
+    packed_mcts_iterations=(mcts_iterations, p3_t3.PackedBoard()),
+    mcts_pool_iterations=(mcts_pool_iterations, p3_t3.Board()),
+    tree_memory=(tree_memory, p3_t3.Board()),
+    selection_depths=(selection_depths, p3_t3.Board()),
+    uct_selection=(uct_selection, p3_t3.Board()),
+    solver_move_check=(solver_move_check, p3_t3.Board()),
+    packed_check=(packed_check, p3_t3.Board()),
+    push_pop_check=(push_pop_check, p3_t3.Board()),
+    zobrist_check=(zobrist_check, p3_t3.Board()),
+    symmetry_check=(symmetry_check, p3_t3.Board()),
+    solver_check=(solver_check, p3_t3.Board()),
+)
+
+node_pool = mcts_node.NodePool()
+
+if p3_batch is not None:
+    benchmarks.update(
+        batch_playouts=(batch_playouts, None),
+        batch_check=(batch_check, p3_t3.Board()),
+    )
+
+if __name__ == '__main__':
+    names = sys.argv[1:] or list(benchmarks.keys())
+    for name in names:
+        if name not in benchmarks:
+            print(name + " not in " + ",".join(benchmarks.keys()))
+            exit(1)
+
+    rounds = 2000
+    for name in names:
+        func, board = benchmarks[name]
+        report(name, func, board, rounds)
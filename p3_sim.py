@@ -1,69 +1,122 @@
 import sys
+from functools import partial
 from timeit import default_timer as time
 import p3_t3
 import mcts_vanilla
 import mcts_vanilla2
 import mcts_modified
+import mcts_parallel
+import p3_solver
 import random_bot
 import rollout_bot
 
+endgame_rollout = p3_solver.EndgameRollout(mcts_vanilla.rollout)
+
 players = dict(
     random_bot=random_bot.think,
     rollout_bot=rollout_bot.think,
     mcts_vanilla=mcts_vanilla.think,
+    mcts_vanilla_tt=partial(mcts_vanilla.think, transpositions=True),
+    mcts_vanilla_sym=partial(mcts_vanilla.think, symmetry_depth=2),
+    mcts_vanilla_rave=partial(mcts_vanilla.think, rave=True),
+    mcts_vanilla_solver=partial(mcts_vanilla.think, solver=True),
+    mcts_vanilla_early=partial(mcts_vanilla.think, early_stop=True, confidence=0.05),
+    mcts_vanilla_bias=partial(mcts_vanilla.think, bias=1.),
+    mcts_vanilla_cutoff=mcts_vanilla.MCTSPlayer(partial(mcts_vanilla.rollout, max_depth=20),
+                                                name="mcts_vanilla_cutoff").think,
+    mcts_vanilla_timed=partial(mcts_vanilla.think, time_limit=1.),
+    mcts_vanilla_reuse=mcts_vanilla.MCTSPlayer().think,
+    mcts_vanilla_endgame=mcts_vanilla.MCTSPlayer(endgame_rollout, name="mcts_vanilla_endgame").think,
     mcts_vanilla2=mcts_vanilla2.think,
-    mcts_modified=mcts_modified.think
+    mcts_modified=mcts_modified.think,
+    mcts_modified_rave=partial(mcts_modified.think, rave=True),
+    mcts_modified_solver=partial(mcts_modified.think, solver=True),
+    mcts_modified_timed=partial(mcts_modified.think, time_limit=1.),
+    mcts_modified_nested=mcts_vanilla.MCTSPlayer(mcts_modified.nested_rollout, check_every=1,
+                                                 name="mcts_modified_nested").think,
+    mcts_modified_reuse=mcts_vanilla.MCTSPlayer(mcts_modified.rollout, check_every=mcts_modified.check_every,
+                                                name="mcts_modified_reuse").think,
+    mcts_root_parallel=mcts_parallel.RootParallelPlayer(workers=4).think,
+    mcts_root_parallel_timed=mcts_parallel.RootParallelPlayer(workers=4, time_limit=1.).think,
+    mcts_root_parallel_shared=mcts_parallel.RootParallelPlayer(workers=4, shared_slots=1 << 16).think,
+    mcts_leaf_parallel=mcts_parallel.LeafParallelPlayer(workers=4).think,
+    mcts_modified_leaf_parallel=mcts_parallel.LeafParallelPlayer(workers=4, rollout=mcts_modified.rollout,
+                                                             name="mcts_modified_leaf_parallel").think
+)
+
+backends = dict(
+    tuple=p3_t3.Board,
+    packed=p3_t3.PackedBoard
 )
 
-board = p3_t3.Board()
-state0 = board.starting_state()
+if __name__ == '__main__':
+    # Worker processes of the parallel players import this module too, and must not start games of their own
+    if len(sys.argv) not in (3, 4):
+        print("Need two player arguments and an optional board backend")
+        exit(1)
 
-if len(sys.argv) != 3:
-    print("Need two player arguments")
-    exit(1)
+    backend = sys.argv[3] if len(sys.argv) == 4 else 'tuple'
+    if backend not in backends:
+        print("backend not in " + ",".join(backends.keys()))
+        exit(1)
 
-p1 = sys.argv[1]
-if p1 not in players:
-    print("p1 not in " + ",".join(players.keys()))
-    exit(1)
-p2 = sys.argv[2]
-if p2 not in players:
-    print("p2 not in " + ",".join(players.keys()))
-    exit(1)
+    board = backends[backend]()
+    state0 = board.starting_state()
 
-player1 = players[p1]
-player2 = players[p2]
+    p1 = sys.argv[1]
+    if p1 not in players:
+        print("p1 not in " + ",".join(players.keys()))
+        exit(1)
+    p2 = sys.argv[2]
+    if p2 not in players:
+        print("p2 not in " + ",".join(players.keys()))
+        exit(1)
 
-rounds = 10
-wins = {'draw':0, 1:0, 2:0}
+    player1 = players[p1]
+    player2 = players[p2]
 
-start = time()  # To log how much time the simulation takes.
-for i in range(rounds):
+    rounds = 10
+    wins = {'draw':0, 1:0, 2:0}
 
-    print("")
-    print("Round %d, fight!" % i)
+    start = time()  # To log how much time the simulation takes.
+    for i in range(rounds):
 
-    state = state0
-    last_action = None
-    current_player = player1
-    while not board.is_ended(state):
-        last_action = current_player(board, state)
-        state = board.next_state(state, last_action)
-        current_player = player1 if current_player == player2 else player2
-    print("Finished!")
-    print()
-    final_score = board.points_values(state)
-    winner = 'draw'
-    if final_score[1] == 1:
-        winner = 1
-    elif final_score[2] == 1:
-        winner = 2
-    print("The %s bot wins this round! (%s)" % (winner, str(final_score)))
-    wins[winner] = wins.get(winner, 0) + 1
+        print("")
+        print("Round %d, fight!" % i)
 
-print("")
-print("Final win counts:", dict(wins))
+        state = state0
+        last_action = None
+        current_player = player1
+        while not board.is_ended(state):
+            last_action = current_player(board, state)
+            state = board.next_state(state, last_action)
+            current_player = player1 if current_player == player2 else player2
+        print("Finished!")
+        print()
+        final_score = board.points_values(state)
+        winner = 'draw'
+        if final_score[1] == 1:
+            winner = 1
+        elif final_score[2] == 1:
+            winner = 2
+        print("The %s bot wins this round! (%s)" % (winner, str(final_score)))
+        if endgame_rollout.solved + endgame_rollout.rolled_out:
+            endgame_rollout.report("mcts_vanilla_endgame")
+            endgame_rollout.reset_counts()
+        for name, cache in (("rollout_bot", rollout_bot.cache), ("mcts_modified_nested", mcts_modified.helper_cache)):
+            if cache.hits + cache.misses:
+                cache.report(name)
+                cache.reset_counts()
+        wins[winner] = wins.get(winner, 0) + 1
+
+    for player in (player1, player2):
+        owner = getattr(player, '__self__', None)  # the player object behind a bound think method
+        if isinstance(owner, mcts_parallel.PoolOwner):
+            owner.close()
+
+    print("")
+    print("Final win counts:", dict(wins))
 
-# Also output the time elapsed.
-end = time()
-print(end - start, ' seconds')
+    # Also output the time elapsed.
+    end = time()
+    print(end - start, ' seconds')
@@ -0,0 +1,163 @@
+from timeit import default_timer as time
+from p3_t3 import has_line, bit_count, all_boards
+
+EXACT, LOWER, UPPER = 0, 1, 2  # what a cached value is: the value, or a lower or upper bound on it
+
+
+class NodeBudgetExceeded(Exception):
+    pass
+
+
+def open_cells(state):
+    """ Returns the number of empty cells in the sub-boards of a BoardState that are not finished yet. """
+    finished = state.b1 | state.b2
+    pieces = state.pieces
+    return sum(bit_count[0x1ff & ~(pieces[2 * board] | pieces[2 * board + 1])]
+               for board in all_boards if not finished & (1 << board))
+
+
+class Solver(object):
+    """ Exact alpha-beta (negamax) search of a game to its end on a p3_t3.BoardState. Values are the points of the
+    player to move: 1, 0 or -1. Searched positions are cached by Zobrist key with whether the value is exact or
+    only a bound, and the cache is kept across searches.
+    """
+
+    def __init__(self, capacity=1 << 18, max_nodes=20000):
+        """
+        Args:
+            capacity:   The number of positions to cache. The cache is emptied when it fills up.
+            max_nodes:  The number of positions a single solve may visit before it gives up.
+
+        """
+        self.capacity = capacity
+        self.max_nodes = max_nodes
+        self.cache = {}
+        self.nodes = 0
+        self.elapsed = 0.
+        self.budget = 0
+
+    def solve(self, state):
+        """ Returns the points_values of state under perfect play, or None if the node budget ran out. The state
+        is left unchanged.
+        """
+        start = time()
+        depth = len(state.history)
+        self.budget = self.nodes + self.max_nodes
+        try:
+            value = self.negamax(state, -1, 1)
+        except NodeBudgetExceeded:
+            while len(state.history) > depth:
+                state.pop()
+            return None
+        finally:
+            self.elapsed += time() - start
+        return {state.player: value, 3 - state.player: -value}
+
+    def negamax(self, state, alpha, beta):
+        self.nodes += 1
+        if self.nodes > self.budget:
+            raise NodeBudgetExceeded()
+
+        points = state.points_values()
+        if points is not None:
+            return points[state.player]
+
+        key = state.key
+        entry = self.cache.get(key)
+        if entry is not None:
+            value, bound = entry
+            if bound == EXACT:
+                return value
+            if bound == LOWER:
+                alpha = max(alpha, value)
+            else:
+                beta = min(beta, value)
+            if alpha >= beta:
+                return value
+
+        original_alpha = alpha
+        best = -2
+        for action in self.ordered_actions(state):
+            state.push(action)
+            value = -self.negamax(state, -beta, -alpha)
+            state.pop()
+            if value > best:
+                best = value
+                if best > alpha:
+                    alpha = best
+                    if alpha >= beta:
+                        break
+
+        if len(self.cache) >= self.capacity:
+            self.cache.clear()
+        if best <= original_alpha:
+            self.cache[key] = (best, UPPER)
+        elif best >= beta:
+            self.cache[key] = (best, LOWER)
+        else:
+            self.cache[key] = (best, EXACT)
+        return best
+
+    @staticmethod
+    def ordered_actions(state):
+        """ The legal actions of state, the ones that win their sub-board first. """
+        pieces = state.pieces
+        offset = state.player - 1
+        winning = []
+        others = []
+        for action in state.legal_actions():
+            R, C, r, c = action
+            board = 3 * R + C
+            if has_line[pieces[2 * board + offset] | 1 << (3 * r + c)]:
+                winning.append(action)
+            else:
+                others.append(action)
+        return winning + others
+
+    def nodes_per_second(self):
+        return self.nodes / self.elapsed if self.elapsed else 0.
+
+
+class EndgameRollout(object):
+    """ A rollout function that solves positions with fewer than threshold empty cells in open sub-boards
+    exactly, and hands the others to the rollout it wraps. It can be given to search or MCTSPlayer wherever a
+    rollout is expected.
+    """
+
+    def __init__(self, rollout, threshold=12, max_nodes=20000, capacity=1 << 18):
+        """
+        Args:
+            rollout:    The rollout to use for positions that are not solved.
+            threshold:  Positions with fewer empty cells than this in open sub-boards are solved.
+            max_nodes:  The node budget of each solve. Positions it does not cover are rolled out instead.
+            capacity:   The number of positions the solver caches.
+
+        """
+        self.rollout = rollout
+        self.threshold = threshold
+        self.solver = Solver(capacity, max_nodes)
+        self.solved = 0
+        self.rolled_out = 0
+
+    def __call__(self, board, state, moves=None):
+        if open_cells(state) < self.threshold:
+            points = self.solver.solve(state)
+            if points is not None:
+                self.solved += 1
+                return points
+        self.rolled_out += 1
+        if moves is None:
+            return self.rollout(board, state)
+        return self.rollout(board, state, moves)
+
+    def report(self, name):
+        print("%s endgame solver: %d/%d rollouts solved, %d nodes in %.2fs (%.0f nodes/sec)" % (
+            name, self.solved, self.solved + self.rolled_out, self.solver.nodes, self.solver.elapsed,
+            self.solver.nodes_per_second()))
+
+    def reset_counts(self):
+        """ Starts the counts over, e.g. for a new game. The solver's cache is kept. """
+        self.solved = 0
+        self.rolled_out = 0
+        self.solver.nodes = 0
+        self.solver.elapsed = 0.
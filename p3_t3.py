@@ -18,6 +18,8 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
+from random import Random
+
 num_players = 2
 
 positions = dict(
@@ -30,17 +32,430 @@ inv_positions = dict(
     (v, P) for P, v in positions.items()
 )
 
+wins = [
+    positions[(r, 0)] | positions[(r, 1)] | positions[(r, 2)]
+    for r in range(3)
+] + [
+    positions[(0, c)] | positions[(1, c)] | positions[(2, c)]
+    for c in range(3)
+] + [
+    positions[(0, 0)] | positions[(1, 1)] | positions[(2, 2)],
+    positions[(0, 2)] | positions[(1, 1)] | positions[(2, 0)],
+]
+
+# Lookup tables indexed by a 9-bit mask, used for both the sub-boards and
+# the big board: does the mask contain a line, and is it full?
+has_line = tuple(
+    any(mask & w == w for w in wins)
+    for mask in range(0x200)
+)
+
+is_full = tuple(
+    mask == 0x1ff
+    for mask in range(0x200)
+)
+
+bit_count = tuple(
+    bin(mask).count('1')
+    for mask in range(0x200)
+)
+
+# completing[mask] is the mask of the cells that would give a line to the
+# player holding the cells of mask.
+completing = tuple(
+    sum(1 << cell for cell in range(9) if not mask & (1 << cell) and has_line[mask | (1 << cell)])
+    for mask in range(0x200)
+)
+
+# Terms of BoardState.move_prior: the preference for each cell of a
+# sub-board (center, then corners), and the score of each kind of move.
+cell_priors = (0.05, 0., 0.05, 0., 0.1, 0., 0.05, 0., 0.05)
+win_prior = 1.
+block_prior = 0.5
+threat_prior = 0.25
+free_choice_prior = -0.5
+
+# action_table[3 * R + C][free] is the tuple of actions on sub-board (R, C)
+# for the 9-bit mask of its free cells, in the same order legal_actions
+# has always listed them.
+action_table = tuple(
+    tuple(
+        tuple(
+            divmod(board, 3) + inv_positions[1 << i]
+            for i in range(9)
+            if free & (1 << i)
+        )
+        for free in range(0x200)
+    )
+    for board in range(9)
+)
+
+# cell_table[free] lists the cell indices 3 * r + c set in a 9-bit mask.
+cell_table = tuple(
+    tuple(i for i in range(9) if free & (1 << i))
+    for free in range(0x200)
+)
+
+all_boards = tuple(range(9))
+
+# Actions as small ints: code 9 * (3 * R + C) + 3 * r + c.
+code_actions = tuple(
+    divmod(code // 9, 3) + divmod(code % 9, 3)
+    for code in range(81)
+)
+
+
+def action_code(action):
+    R, C, r, c = action
+    return 9 * (3 * R + C) + 3 * r + c
+
+
+# Moves with their player, (player, R, C, r, c), as the code 81 * (player - 1) + action code.
+def move_code(player, action):
+    return 81 * (player - 1) + action_code(action)
+
+
+def actions_mask(actions):
+    """ Returns the set of actions as an 81-bit mask with bit action_code(action) set for each. """
+    mask = 0
+    for action in actions:
+        mask |= 1 << action_code(action)
+    return mask
+
+
+def random_code(mask, rng):
+    """ Picks one of the action codes set in an 81-bit mask uniformly at random, nine bits at a time. """
+    k = int(rng.random() * bin(mask).count('1'))
+    code = 0
+    while True:
+        cells = mask & 0x1ff
+        if k < bit_count[cells]:
+            return code + cell_table[cells][k]
+        k -= bit_count[cells]
+        mask >>= 9
+        code += 9
+
+# Zobrist keys: one 64-bit key per (sub-board mask index, cell), per (player,
+# big-board cell) and per required board (index 9 for unconstrained), plus
+# one that is xored in when player 2 is to move. A fixed seed keeps keys
+# equal across processes.
+zobrist_rng = Random(0x7a3)
+zobrist_pieces = tuple(
+    tuple(zobrist_rng.getrandbits(64) for cell in range(9))
+    for index in range(18)
+)
+zobrist_boards = tuple(
+    tuple(zobrist_rng.getrandbits(64) for board in range(9))
+    for player in range(2)
+)
+zobrist_constraint = tuple(zobrist_rng.getrandbits(64) for board in range(10))
+zobrist_player = zobrist_rng.getrandbits(64)
+
+
+def zobrist_key(pieces, b1, b2, constraint, player):
+    """ Computes the Zobrist key of a position given as the values of Board.bitmasks. """
+    key = zobrist_constraint[9 if constraint is None else constraint]
+    if player == 2:
+        key ^= zobrist_player
+    for index in range(18):
+        for cell in cell_table[pieces[index]]:
+            key ^= zobrist_pieces[index][cell]
+    for cell in cell_table[b1]:
+        key ^= zobrist_boards[0][cell]
+    for cell in cell_table[b2]:
+        key ^= zobrist_boards[1][cell]
+    return key
+
+
+# The 8 symmetries of the square as maps of (r, c). Each one acts on the big
+# board and on every sub-board at once, so it also maps actions (R, C, r, c).
+symmetry_maps = (
+    lambda r, c: (r, c),
+    lambda r, c: (c, 2 - r),
+    lambda r, c: (2 - r, 2 - c),
+    lambda r, c: (2 - c, r),
+    lambda r, c: (r, 2 - c),
+    lambda r, c: (2 - r, c),
+    lambda r, c: (c, r),
+    lambda r, c: (2 - c, 2 - r),
+)
+
+# symmetry_cells[s][3 * r + c] is the image cell index under symmetry s,
+# and symmetry_masks[s][mask] the image of a 9-bit mask.
+symmetry_cells = tuple(
+    tuple(3 * f(r, c)[0] + f(r, c)[1] for r in range(3) for c in range(3))
+    for f in symmetry_maps
+)
+symmetry_masks = tuple(
+    tuple(
+        sum(1 << cells[cell] for cell in cell_table[mask])
+        for mask in range(0x200)
+    )
+    for cells in symmetry_cells
+)
+inverse_symmetry = tuple(
+    next(t for t in range(8) if all(symmetry_cells[t][symmetry_cells[s][i]] == i for i in range(9)))
+    for s in range(8)
+)
+
+
+# symmetry_product[s][t] is the symmetry that applies t and then s.
+symmetry_product = tuple(
+    tuple(
+        next(u for u in range(8) if all(symmetry_cells[u][i] == symmetry_cells[s][symmetry_cells[t][i]]
+                                        for i in range(9)))
+        for t in range(8)
+    )
+    for s in range(8)
+)
+
+# symmetry_codes[s][code] is the image of action code 9 * (3 * R + C) + 3 * r + c under symmetry s.
+symmetry_codes = tuple(
+    tuple(9 * cells[code // 9] + cells[code % 9] for code in range(81))
+    for cells in symmetry_cells
+)
+
+
+def transform_code(code, s):
+    """ Returns the image under symmetry s of an action code, or of a move_code. """
+    return 81 * (code // 81) + symmetry_codes[s][code % 81]
+
+
+def transform_code_mask(mask, s):
+    """ Returns the image under symmetry s of a mask of action codes, see actions_mask. """
+    codes = symmetry_codes[s]
+    moved = 0
+    while mask:
+        low = mask & -mask
+        mask ^= low
+        moved |= 1 << codes[low.bit_length() - 1]
+    return moved
+
+
+def transform_bitmasks(pieces, b1, b2, constraint, s):
+    """ Applies symmetry s to the values of Board.bitmasks (the player to move is unaffected).
+
+    Returns:    The transformed pieces list, big-board masks and constraint.
+
+    """
+    cells, masks = symmetry_cells[s], symmetry_masks[s]
+    moved = [0] * 18
+    for board in all_boards:
+        moved[2 * cells[board]] = masks[pieces[2 * board]]
+        moved[2 * cells[board] + 1] = masks[pieces[2 * board + 1]]
+    return moved, masks[b1], masks[b2], None if constraint is None else cells[constraint]
+
+
+def stabilizer(pieces, b1, b2, constraint):
+    """ Returns the symmetries other than the identity that leave a position unchanged. """
+    found = []
+    for s in range(1, 8):
+        cells, masks = symmetry_cells[s], symmetry_masks[s]
+        if masks[b1] != b1 or masks[b2] != b2:
+            continue
+        if constraint is not None and cells[constraint] != constraint:
+            continue
+        if all(masks[pieces[2 * board]] == pieces[2 * cells[board]] and
+               masks[pieces[2 * board + 1]] == pieces[2 * cells[board] + 1]
+               for board in all_boards):
+            found.append(s)
+    return found
+
+
+def transform_action(action, s):
+    """ Returns the image of action (R, C, r, c) under symmetry s. """
+    R, C, r, c = action
+    cells = symmetry_cells[s]
+    return divmod(cells[3 * R + C], 3) + divmod(cells[3 * r + c], 3)
+
+
+def distinct_actions(actions, symmetries):
+    """ Keeps one action of each class of actions that the given symmetries map onto each other. """
+    if not symmetries:
+        return actions
+    kept = []
+    for action in actions:
+        R, C, r, c = action
+        board, cell = 3 * R + C, 3 * r + c
+        code = 9 * board + cell
+        if all(9 * symmetry_cells[s][board] + symmetry_cells[s][cell] >= code for s in symmetries):
+            kept.append(action)
+    return kept
+
+
+# Weights of the static evaluation: per box owned, per unfinished box that
+# would complete a big-board line, and for the player to move having a free
+# choice of sub-board. Fit by least squares to the results of random games.
+box_weight = 0.1
+threat_weight = 0.12
+freedom_weight = 0.02
+
+
+def static_value(b1, b2, constraint, player):
+    """ Scores an unfinished position for player 1 from the big-board masks, in [-1, 1] like points_values. """
+    p1 = b1 & ~b2
+    p2 = b2 & ~b1
+    open_boards = 0x1ff & ~(b1 | b2)
+    value = (box_weight * (bit_count[p1] - bit_count[p2]) +
+             threat_weight * (bit_count[completing[p1] & open_boards] - bit_count[completing[p2] & open_boards]))
+    if constraint is None:
+        value += freedom_weight if player == 1 else -freedom_weight
+    return max(-1., min(1., value))
+
+
+def playout_bitmasks(pieces, b1, b2, constraint, player, rng, max_depth=None, moves=None, evaluate=False):
+    """ The loop behind Board.playout, run on the values of Board.bitmasks. The pieces list is modified. """
+    random = rng.random
+    depth = -1 if max_depth is None else max_depth
+
+    while depth:
+        p1 = b1 & ~b2
+        p2 = b2 & ~b1
+        if has_line[p1] or has_line[p2] or is_full[b1 | b2]:
+            break
+        depth -= 1
+
+        if constraint is None:
+            finished = b1 | b2
+            count = 0
+            for board in all_boards:
+                if not finished & (1 << board):
+                    count += bit_count[0x1ff & ~(pieces[2 * board] | pieces[2 * board + 1])]
+            k = int(random() * count)
+            for board in all_boards:
+                if not finished & (1 << board):
+                    free = 0x1ff & ~(pieces[2 * board] | pieces[2 * board + 1])
+                    if k < bit_count[free]:
+                        break
+                    k -= bit_count[free]
+        else:
+            board = constraint
+            free = 0x1ff & ~(pieces[2 * board] | pieces[2 * board + 1])
+            k = int(random() * bit_count[free])
+
+        cell = cell_table[free][k]
+        index = 2 * board + player - 1
+        pieces[index] |= 1 << cell
+        if moves is not None:
+            moves.append(81 * (player - 1) + 9 * board + cell)
+        if has_line[pieces[index]]:
+            if player == 1:
+                b1 |= 1 << board
+            else:
+                b2 |= 1 << board
+        elif is_full[pieces[2 * board] | pieces[2 * board + 1]]:
+            b1 |= 1 << board
+            b2 |= 1 << board
+
+        constraint = None if (b1 | b2) & (1 << cell) else cell
+        player = 3 - player
+
+    p1 = b1 & ~b2
+    p2 = b2 & ~b1
+    points = None
+    if has_line[p1]:
+        points = {1: 1, 2: -1}
+    elif has_line[p2]:
+        points = {1: -1, 2: 1}
+    elif is_full[b1 | b2]:
+        points = {1: 0, 2: 0}
+    elif evaluate:
+        value = static_value(b1, b2, constraint, player)
+        points = {1: value, 2: -value}
+    return points, (bit_count[p1], bit_count[p2])
+
+
+def heavy_playout_bitmasks(pieces, b1, b2, constraint, player, rng, max_depth=None, moves=None, evaluate=False):
+    """ playout_bitmasks with a rule-based policy instead of uniformly random moves. Among the open sub-boards
+    the mover may play in, it picks at random among the moves of the first kind there are any of:
+
+        1. moves that win their sub-board,
+        2. moves that block an opponent line in their sub-board,
+        3. moves that do not give the opponent a free choice of sub-board,
+        4. any move.
+
+    Returns:    The points values of the final state (None if it is not over) and the numbers of boxes owned.
+
+    """
+    random = rng.random
+    depth = -1 if max_depth is None else max_depth
+
+    while depth:
+        p1 = b1 & ~b2
+        p2 = b2 & ~b1
+        if has_line[p1] or has_line[p2] or is_full[b1 | b2]:
+            break
+        depth -= 1
+
+        finished = b1 | b2
+        own, other = player - 1, 2 - player
+        best = 4
+        options = []  # (board, cells) of the best kind of move so far
+        for board in (all_boards if constraint is None else (constraint,)):
+            if finished & (1 << board):
+                continue
+            free = 0x1ff & ~(pieces[2 * board] | pieces[2 * board + 1])
+            cells = completing[pieces[2 * board + own]] & free
+            kind = 1
+            if not cells:
+                cells = completing[pieces[2 * board + other]] & free
+                kind = 2
+                if not cells:
+                    cells = free & ~finished  # the cell is the board the opponent is sent to
+                    kind = 3
+                    if not cells:
+                        cells = free
+                        kind = 4
+            if kind < best:
+                best = kind
+                options = [(board, cells)]
+            elif kind == best:
+                options.append((board, cells))
+
+        if len(options) == 1:
+            board, cells = options[0]
+            k = int(random() * bit_count[cells])
+        else:
+            k = int(random() * sum(bit_count[cells] for board, cells in options))
+            for board, cells in options:
+                if k < bit_count[cells]:
+                    break
+                k -= bit_count[cells]
+        cell = cell_table[cells][k]
+
+        index = 2 * board + own
+        pieces[index] |= 1 << cell
+        if moves is not None:
+            moves.append(81 * own + 9 * board + cell)
+        if has_line[pieces[index]]:
+            if player == 1:
+                b1 |= 1 << board
+            else:
+                b2 |= 1 << board
+        elif is_full[pieces[2 * board] | pieces[2 * board + 1]]:
+            b1 |= 1 << board
+            b2 |= 1 << board
+
+        constraint = None if (b1 | b2) & (1 << cell) else cell
+        player = 3 - player
+
+    p1 = b1 & ~b2
+    p2 = b2 & ~b1
+    points = None
+    if has_line[p1]:
+        points = {1: 1, 2: -1}
+    elif has_line[p2]:
+        points = {1: -1, 2: 1}
+    elif is_full[b1 | b2]:
+        points = {1: 0, 2: 0}
+    elif evaluate:
+        value = static_value(b1, b2, constraint, player)
+        points = {1: value, 2: -value}
+    return points, (bit_count[p1], bit_count[p2])
+
+
 class Board(object):
-    wins = [
-        positions[(r, 0)] | positions[(r, 1)] | positions[(r, 2)]
-        for r in range(3)
-    ] + [
-        positions[(0, c)] | positions[(1, c)] | positions[(2, c)]
-        for c in range(3)
-    ] + [
-        positions[(0, 0)] | positions[(1, 1)] | positions[(2, 2)],
-        positions[(0, 2)] | positions[(1, 1)] | positions[(2, 0)],
-    ]
+    wins = wins
 
     def starting_state(self):
         # Each of the 9 pairs of player 1 and player 2 board bitmasks
@@ -49,6 +464,13 @@ class Board(object):
         # and finally the player number to move.
         return (0, 0) * 10 + (None, None, 1)
 
+    def from_tuple(self, state):
+        """ Converts a tuple state to this board's state type. Other backends override these two. """
+        return state
+
+    def to_tuple(self, state):
+        return state
+
     def display(self, state, action, _unicode=True):
         actions = dict(
             ((R, C, r, c), p)
@@ -194,10 +616,9 @@ class Board(object):
         state[board_index + player_index] |= positions[(r, c)]
         updated_board = state[board_index + player_index]
 
-        full = (state[board_index] | state[board_index + 1] == 0x1ff)
-        if any(updated_board & w == w for w in self.wins):
+        if has_line[updated_board]:
             state[18 + player_index] |= positions[(R, C)]
-        elif full:
+        elif is_full[state[board_index] | state[board_index + 1]]:
             state[18] |= positions[(R, C)]
             state[19] |= positions[(R, C)]
 
@@ -238,47 +659,51 @@ class Board(object):
         # Otherwise, we must play in the proper sub-board.
         return (R, C) == (state[20], state[21])
 
-    def legal_actions(self, state):
-        R, C = state[20], state[21]
-        Rset, Cset = (R,), (C,)
-        if R is None:
-            Rset, Cset = range(3), range(3)
-
-        occupied = [
-            state[2 * x] | state[2 * x + 1] for x in range(9)
-        ]
+    def open_boards(self, state):
+        """ Returns the indices 3 * R + C of the sub-boards the player to move may play in. """
         finished = state[18] | state[19]
+        if state[20] is not None:
+            board = 3 * state[20] + state[21]
+            return () if finished & (1 << board) else (board,)
+        return tuple(board for board in all_boards if not finished & (1 << board))
 
-        actions = [
-            (R, C, r, c)
-            for R in Rset
-            for C in Cset
-            for r in range(3)
-            for c in range(3)
-            if not occupied[3 * R + C] & positions[(r, c)]
-            and not finished & positions[(R, C)]
-        ]
+    def free_cells(self, state, board):
+        """ Returns the 9-bit mask of empty cells of sub-board 3 * R + C. """
+        return 0x1ff & ~(state[2 * board] | state[2 * board + 1])
 
+    def legal_actions(self, state):
+        actions = []
+        for board in self.open_boards(state):
+            actions.extend(action_table[board][self.free_cells(state, board)])
         return actions
 
+    def legal_action_count(self, state):
+        return sum(bit_count[self.free_cells(state, board)] for board in self.open_boards(state))
+
+    def legal_action(self, state, k):
+        """ Returns the k-th entry of legal_actions(state) without building the list. """
+        for board in self.open_boards(state):
+            free = self.free_cells(state, board)
+            if k < bit_count[free]:
+                return action_table[board][free][k]
+            k -= bit_count[free]
+        raise IndexError("legal action index out of range")
+
     def previous_player(self, state):
         return 3 - state[-1]
 
     def current_player(self, state):
         return state[-1]
 
+    def big_boards(self, state):
+        """ Returns the p1 and p2 big-board masks. A board in both masks is full without a winner. """
+        return state[18], state[19]
+
     def is_ended(self, state):
         p1 = state[18] & ~state[19]
         p2 = state[19] & ~state[18]
 
-        if any(w & p1 == w for w in self.wins):
-            return True
-        if any(w & p2 == w for w in self.wins):
-            return True
-        if state[18] | state[19] == 0x1ff:
-            return True
-
-        return False
+        return has_line[p1] or has_line[p2] or is_full[state[18] | state[19]]
 
     def win_values(self, state):
         if not self.is_ended(state):
@@ -286,11 +711,11 @@ class Board(object):
         p1 = state[18] & ~state[19]
         p2 = state[19] & ~state[18]
 
-        if any(w & p1 == w for w in self.wins):
+        if has_line[p1]:
             return {1: 1, 2: 0}
-        if any(w & p2 == w for w in self.wins):
+        if has_line[p2]:
             return {1: 0, 2: 1}
-        if state[18] | state[19] == 0x1ff:
+        if is_full[state[18] | state[19]]:
             return {1: 0.5, 2: 0.5}
 
     def owned_boxes(self, state):
@@ -313,16 +738,454 @@ class Board(object):
         p1 = state[18] & ~state[19]
         p2 = state[19] & ~state[18]
 
-        if any(w & p1 == w for w in self.wins):
+        if has_line[p1]:
             return {1: 1, 2: -1}
-        if any(w & p2 == w for w in self.wins):
+        if has_line[p2]:
             return {1: -1, 2: 1}
-        if state[18] | state[19] == 0x1ff:
+        if is_full[state[18] | state[19]]:
             return {1: 0, 2: 0}
 
+    def bitmasks(self, state):
+        """ Returns a mutable list of the 18 sub-board masks, the two big-board masks, the index 3 * R + C of the
+        required board (None when unconstrained) and the player to move. """
+        constraint = None if state[20] is None else 3 * state[20] + state[21]
+        return list(state[:18]), state[18], state[19], constraint, state[22]
+
+    def required_board(self, state):
+        """ Returns the index 3 * R + C of the board the next move must be played in, or None. """
+        if state[20] is None:
+            return None
+        return 3 * state[20] + state[21]
+
+    def zobrist(self, state):
+        """ Returns the 64-bit Zobrist key of state. """
+        return zobrist_key(*self.bitmasks(state))
+
+    def next_state_key(self, state, key, action):
+        """ Like next_state, but also updates the Zobrist key of state incrementally.
+
+        Returns:    The next state and its Zobrist key.
+
+        """
+        R, C, r, c = action
+        board = 3 * R + C
+        player = self.current_player(state)
+        b1, b2 = self.big_boards(state)
+        constraint = self.required_board(state)
+
+        next_state = self.next_state(state, action)
+        next_b1, next_b2 = self.big_boards(next_state)
+        next_constraint = self.required_board(next_state)
+
+        key ^= zobrist_pieces[2 * board + player - 1][3 * r + c] ^ zobrist_player
+        if next_b1 != b1:
+            key ^= zobrist_boards[0][board]
+        if next_b2 != b2:
+            key ^= zobrist_boards[1][board]
+        if next_constraint != constraint:
+            key ^= zobrist_constraint[9 if constraint is None else constraint]
+            key ^= zobrist_constraint[9 if next_constraint is None else next_constraint]
+        return next_state, key
+
+    def transform(self, state, s):
+        """ Returns the image of state under symmetry s, one of the 8 indices into symmetry_maps. """
+        pieces, b1, b2, constraint, player = self.bitmasks(state)
+        pieces, b1, b2, constraint = transform_bitmasks(pieces, b1, b2, constraint, s)
+        constraint = (None, None) if constraint is None else divmod(constraint, 3)
+        return self.from_tuple(tuple(pieces) + (b1, b2) + constraint + (player,))
+
+    def canonical(self, state):
+        """ Returns the canonical representative of the 8 images of state and the symmetry s that maps state to
+        it. Equivalent states have the same canonical state, and an action a in state corresponds to
+        transform_action(a, s) in the canonical one; inverse_symmetry[s] maps back. """
+        pieces, b1, b2, constraint, player = self.bitmasks(state)
+        best, best_s = None, 0
+        for s in range(8):
+            moved, m1, m2, moved_constraint = transform_bitmasks(pieces, b1, b2, constraint, s)
+            order = tuple(moved) + (m1, m2, 9 if moved_constraint is None else moved_constraint)
+            if best is None or order < best:
+                best, best_s = order, s
+        return self.transform(state, best_s), best_s
+
+    def transform_action(self, action, s):
+        return transform_action(action, s)
+
+    def symmetries(self, state):
+        """ Returns the symmetries other than the identity that map state onto itself. """
+        pieces, b1, b2, constraint, player = self.bitmasks(state)
+        return stabilizer(pieces, b1, b2, constraint)
+
+    def distinct_actions(self, state):
+        """ Returns the legal actions of state, keeping one of each set of actions that lead to symmetric
+        positions. """
+        return distinct_actions(self.legal_actions(state), self.symmetries(state))
+
+    def playout(self, state, rng, max_depth=None, moves=None, evaluate=False):
+        """ Plays random moves from state until the game ends, or until max_depth moves have been made.
+
+        Args:
+            state:      The state to play from.
+            rng:        A random.Random instance or the random module.
+            max_depth:  Optional cap on the number of moves played.
+            moves:      Optional list the move_code of each move played is appended to.
+            evaluate:   Whether to score a final state that is not over with static_value instead of None.
+
+        Returns:        The points_values of the final state (None if it is not over, unless evaluated) and the
+                        number of boxes owned by player 1 and player 2.
+
+        """
+        pieces, b1, b2, constraint, player = self.bitmasks(state)
+        return playout_bitmasks(pieces, b1, b2, constraint, player, rng, max_depth, moves, evaluate)
+
     def winner_message(self, winners):
         winners = sorted((v, k) for k, v in winners.items())
         value, winner = winners[-1]
         if value == 0.5:
             return "Draw."
         return "Winner: Player {0}.".format(winner)
+
+
+# Bit layout of a PackedBoard state: the 20 masks of the tuple state at 9
+# bits each, then the index 3 * R + C of the required board (or 9 when
+# unconstrained) and finally the player number to move.
+MASK_BITS = 9
+CONSTRAINT_SHIFT = 20 * MASK_BITS
+PLAYER_SHIFT = CONSTRAINT_SHIFT + 4
+UNCONSTRAINED = 9
+P1_BOARDS_SHIFT = 18 * MASK_BITS
+P2_BOARDS_SHIFT = 19 * MASK_BITS
+MASKS = (1 << CONSTRAINT_SHIFT) - 1
+
+# packed_moves[player][action] holds what PackedBoard.next_state needs for
+# player playing action, so that it only shifts and masks what it has to:
+# (the cell's bit, the shift of the sub-board's player 1 mask, the shift of
+# the player's mask, the player's big-board bit for the sub-board, both
+# big-board bits of the sub-board, both big-board bits of the cell's board
+# (finished means unconstrained), the constraint and next player bits when
+# the cell's board is open, and the same when it is finished).
+packed_moves = (None,) + tuple(
+    dict(
+        (code_actions[code], (
+            1 << (MASK_BITS * (2 * (code // 9) + player - 1) + code % 9),
+            MASK_BITS * 2 * (code // 9),
+            MASK_BITS * (2 * (code // 9) + player - 1),
+            1 << (code // 9 + (P1_BOARDS_SHIFT if player == 1 else P2_BOARDS_SHIFT)),
+            1 << (code // 9 + P1_BOARDS_SHIFT) | 1 << (code // 9 + P2_BOARDS_SHIFT),
+            1 << (code % 9 + P1_BOARDS_SHIFT) | 1 << (code % 9 + P2_BOARDS_SHIFT),
+            (code % 9) << CONSTRAINT_SHIFT | (3 - player) << PLAYER_SHIFT,
+            UNCONSTRAINED << CONSTRAINT_SHIFT | (3 - player) << PLAYER_SHIFT))
+        for code in range(81)
+    )
+    for player in (1, 2)
+)
+
+# board_shifts[3 * R + C] is the shift of sub-board (R, C)'s player 1 mask.
+board_shifts = tuple(MASK_BITS * 2 * board for board in all_boards)
+
+
+class PackedBoard(Board):
+    """ A Board whose state is a single packed int instead of a 23-tuple. It
+    answers the same queries as Board, so bots can use either backend. """
+
+    def starting_state(self):
+        return self.from_tuple(Board.starting_state(self))
+
+    def from_tuple(self, state):
+        packed = 0
+        for i in range(20):
+            packed |= state[i] << (MASK_BITS * i)
+        constraint = UNCONSTRAINED
+        if state[20] is not None:
+            constraint = 3 * state[20] + state[21]
+        return packed | constraint << CONSTRAINT_SHIFT | state[22] << PLAYER_SHIFT
+
+    def to_tuple(self, state):
+        masks = [(state >> (MASK_BITS * i)) & 0x1ff for i in range(20)]
+        constraint = (state >> CONSTRAINT_SHIFT) & 0xf
+        if constraint == UNCONSTRAINED:
+            masks.extend([None, None])
+        else:
+            masks.extend(divmod(constraint, 3))
+        masks.append(state >> PLAYER_SHIFT)
+        return tuple(masks)
+
+    def display(self, state, action, _unicode=True):
+        return Board.display(self, self.to_tuple(state), action, _unicode)
+
+    def pack_state(self, data):
+        return self.from_tuple(Board.pack_state(self, data))
+
+    def unpack_state(self, state):
+        return Board.unpack_state(self, self.to_tuple(state))
+
+    def next_state(self, state, action):
+        bit, board_shift, shift, won, full, finished, tail, free_tail = \
+            packed_moves[state >> PLAYER_SHIFT][action]
+
+        state = (state | bit) & MASKS
+        if has_line[(state >> shift) & 0x1ff]:
+            state |= won
+        else:
+            occupied = state >> board_shift
+            if is_full[(occupied | occupied >> MASK_BITS) & 0x1ff]:
+                state |= full
+
+        return state | (free_tail if state & finished else tail)
+
+    def is_legal(self, state, action):
+        R, C, r, c = action
+
+        # Is action out of bounds?
+        if (R, C) not in positions:
+            return False
+        if (r, c) not in positions:
+            return False
+
+        board = 3 * R + C
+        occupied = (state >> (MASK_BITS * 2 * board)) & 0x3ffff
+        if positions[(r, c)] & (occupied | occupied >> MASK_BITS):
+            return False
+
+        finished = state >> P1_BOARDS_SHIFT | state >> P2_BOARDS_SHIFT
+        if finished & positions[(R, C)]:
+            return False
+
+        constraint = (state >> CONSTRAINT_SHIFT) & 0xf
+        return constraint == UNCONSTRAINED or constraint == board
+
+    def open_boards(self, state):
+        finished = state >> P1_BOARDS_SHIFT | state >> P2_BOARDS_SHIFT
+        constraint = (state >> CONSTRAINT_SHIFT) & 0xf
+        if constraint != UNCONSTRAINED:
+            return () if finished & (1 << constraint) else (constraint,)
+        return tuple(board for board in all_boards if not finished & (1 << board))
+
+    def free_cells(self, state, board):
+        occupied = state >> board_shifts[board]
+        return 0x1ff & ~(occupied | occupied >> MASK_BITS)
+
+    def legal_actions(self, state):
+        # Board.legal_actions with open_boards and free_cells inlined
+        finished = state >> P1_BOARDS_SHIFT | state >> P2_BOARDS_SHIFT
+        constraint = (state >> CONSTRAINT_SHIFT) & 0xf
+        if constraint != UNCONSTRAINED:
+            if finished & (1 << constraint):
+                return []
+            occupied = state >> board_shifts[constraint]
+            return list(action_table[constraint][0x1ff & ~(occupied | occupied >> MASK_BITS)])
+        actions = []
+        for board in all_boards:
+            if not finished & (1 << board):
+                occupied = state >> board_shifts[board]
+                actions.extend(action_table[board][0x1ff & ~(occupied | occupied >> MASK_BITS)])
+        return actions
+
+    def bitmasks(self, state):
+        pieces = [(state >> (MASK_BITS * i)) & 0x1ff for i in range(18)]
+        b1, b2 = self.big_boards(state)
+        return pieces, b1, b2, self.required_board(state), state >> PLAYER_SHIFT
+
+    def required_board(self, state):
+        constraint = (state >> CONSTRAINT_SHIFT) & 0xf
+        return None if constraint == UNCONSTRAINED else constraint
+
+    def previous_player(self, state):
+        return 3 - (state >> PLAYER_SHIFT)
+
+    def current_player(self, state):
+        return state >> PLAYER_SHIFT
+
+    def big_boards(self, state):
+        return (state >> P1_BOARDS_SHIFT) & 0x1ff, (state >> P2_BOARDS_SHIFT) & 0x1ff
+
+    def is_ended(self, state):
+        b1 = (state >> P1_BOARDS_SHIFT) & 0x1ff
+        b2 = (state >> P2_BOARDS_SHIFT) & 0x1ff
+        return has_line[b1 & ~b2] or has_line[b2 & ~b1] or is_full[b1 | b2]
+
+    def win_values(self, state):
+        b1, b2 = self.big_boards(state)
+        p1 = b1 & ~b2
+        p2 = b2 & ~b1
+
+        if has_line[p1]:
+            return {1: 1, 2: 0}
+        if has_line[p2]:
+            return {1: 0, 2: 1}
+        if is_full[b1 | b2]:
+            return {1: 0.5, 2: 0.5}
+
+    def owned_boxes(self, state):
+        return Board.owned_boxes(self, self.to_tuple(state))
+
+    def points_values(self, state):
+        b1, b2 = self.big_boards(state)
+        p1 = b1 & ~b2
+        p2 = b2 & ~b1
+
+        if has_line[p1]:
+            return {1: 1, 2: -1}
+        if has_line[p2]:
+            return {1: -1, 2: 1}
+        if is_full[b1 | b2]:
+            return {1: 0, 2: 0}
+
+
+class BoardState(object):
+    """ A mutable game state for walking a search tree in place. push(action) plays a move on the bitmasks and
+    pop() takes back the last one, restoring the big-board masks and the constraint exactly. The Zobrist key of
+    the position is kept in key. """
+
+    def __init__(self, board, state):
+        self.board = board
+        self.pieces, self.b1, self.b2, self.constraint, self.player = board.bitmasks(state)
+        self.key = zobrist_key(self.pieces, self.b1, self.b2, self.constraint, self.player)
+        self.history = []
+
+    def push(self, action):
+        R, C, r, c = action
+        board = 3 * R + C
+        cell = 3 * r + c
+        index = 2 * board + self.player - 1
+        pieces = self.pieces
+        b1, b2 = self.b1, self.b2
+        constraint = self.constraint
+        key = self.key
+        self.history.append((index, cell, b1, b2, constraint, key))
+
+        pieces[index] |= 1 << cell
+        key ^= zobrist_pieces[index][cell] ^ zobrist_player
+        if has_line[pieces[index]]:
+            if self.player == 1:
+                b1 |= 1 << board
+                key ^= zobrist_boards[0][board]
+            else:
+                b2 |= 1 << board
+                key ^= zobrist_boards[1][board]
+        elif is_full[pieces[2 * board] | pieces[2 * board + 1]]:
+            b1 |= 1 << board
+            b2 |= 1 << board
+            key ^= zobrist_boards[0][board] ^ zobrist_boards[1][board]
+
+        self.b1, self.b2 = b1, b2
+        self.constraint = None if (b1 | b2) & (1 << cell) else cell
+        key ^= zobrist_constraint[9 if constraint is None else constraint]
+        self.key = key ^ zobrist_constraint[9 if self.constraint is None else self.constraint]
+        self.player = 3 - self.player
+
+    def pop(self):
+        index, cell, self.b1, self.b2, self.constraint, self.key = self.history.pop()
+        self.pieces[index] &= ~(1 << cell)
+        self.player = 3 - self.player
+
+    def path_moves(self):
+        """ Returns the move_code of each move pushed, in order. """
+        return [81 * (index & 1) + 9 * (index >> 1) + cell for index, cell, b1, b2, constraint, key in self.history]
+
+    def path_keys(self):
+        """ Returns the Zobrist keys of the positions since the first pushed move, ending with the current one. """
+        return [undo[5] for undo in self.history] + [self.key]
+
+    def to_state(self):
+        """ Returns the current position as a state of the board this was built from. """
+        constraint = (None, None) if self.constraint is None else divmod(self.constraint, 3)
+        return self.board.from_tuple(tuple(self.pieces) + (self.b1, self.b2) + constraint + (self.player,))
+
+    def current_player(self):
+        return self.player
+
+    def is_ended(self):
+        b1, b2 = self.b1, self.b2
+        return has_line[b1 & ~b2] or has_line[b2 & ~b1] or is_full[b1 | b2]
+
+    def points_values(self):
+        b1, b2 = self.b1, self.b2
+        if has_line[b1 & ~b2]:
+            return {1: 1, 2: -1}
+        if has_line[b2 & ~b1]:
+            return {1: -1, 2: 1}
+        if is_full[b1 | b2]:
+            return {1: 0, 2: 0}
+
+    def legal_actions(self):
+        finished = self.b1 | self.b2
+        boards = all_boards if self.constraint is None else (self.constraint,)
+        pieces = self.pieces
+        actions = []
+        for board in boards:
+            if not finished & (1 << board):
+                actions.extend(action_table[board][0x1ff & ~(pieces[2 * board] | pieces[2 * board + 1])])
+        return actions
+
+    def move_prior(self, action):
+        """ A quick score of action for the player to move, from the masks of the sub-board it is played in and of
+        the one it sends the opponent to. Winning the sub-board, blocking an opponent line and making a new
+        two-in-a-row score higher, giving the opponent a free choice or a sub-board they can win at once lower.
+        """
+        R, C, r, c = action
+        board = 3 * R + C
+        cell = 3 * r + c
+        bit = 1 << cell
+        pieces = self.pieces
+        own = pieces[2 * board + self.player - 1]
+        other = pieces[2 * board + 2 - self.player]
+        free = 0x1ff & ~(own | other | bit)
+
+        prior = cell_priors[cell]
+        won = completing[own] & bit
+        if won:
+            prior += win_prior
+        elif completing[other] & bit:
+            prior += block_prior
+        elif completing[own | bit] & ~completing[own] & free:
+            prior += threat_prior
+
+        if (self.b1 | self.b2) & (1 << cell) or cell == board and (won or not free):
+            prior += free_choice_prior  # the opponent may then play anywhere
+        elif completing[pieces[2 * cell + 2 - self.player]] & ~(pieces[2 * cell] | pieces[2 * cell + 1] |
+                                                                 (bit if cell == board else 0)):
+            prior += free_choice_prior  # the opponent can win the sub-board they are sent to
+        return prior
+
+    def legal_mask(self):
+        """ Returns legal_actions as a mask of action codes, see actions_mask. """
+        finished = self.b1 | self.b2
+        boards = all_boards if self.constraint is None else (self.constraint,)
+        pieces = self.pieces
+        mask = 0
+        for board in boards:
+            if not finished & (1 << board):
+                mask |= (0x1ff & ~(pieces[2 * board] | pieces[2 * board + 1])) << (9 * board)
+        return mask
+
+    def distinct_actions(self):
+        return distinct_actions(self.legal_actions(), stabilizer(self.pieces, self.b1, self.b2, self.constraint))
+
+    def symmetries(self):
+        """ Returns the symmetries other than the identity that map the position onto itself. """
+        return stabilizer(self.pieces, self.b1, self.b2, self.constraint)
+
+    def canonical_key(self, symmetries):
+        """ Returns the smallest Zobrist key of the images of the position under the given symmetries, and the
+        symmetry that gives it. Positions that one of the symmetries maps onto each other get the same key, as
+        long as the symmetries form a group, e.g. the identity and the symmetries() of some position. """
+        best_key, best_s = None, 0
+        for s in symmetries:
+            if s == 0:
+                key = self.key
+            else:
+                key = zobrist_key(*transform_bitmasks(self.pieces, self.b1, self.b2, self.constraint, s),
+                                  self.player)
+            if best_key is None or key < best_key:
+                best_key, best_s = key, s
+        return best_key, best_s
+
+    def playout(self, rng, max_depth=None, moves=None, evaluate=False):
+        """ Board.playout from the current position, leaving this state unchanged. """
+        return playout_bitmasks(list(self.pieces), self.b1, self.b2, self.constraint, self.player, rng, max_depth,
+                                moves, evaluate)
+
+    def heavy_playout(self, rng, max_depth=None, moves=None, evaluate=False):
+        """ playout with the policy of heavy_playout_bitmasks. """
+        return heavy_playout_bitmasks(list(self.pieces), self.b1, self.b2, self.constraint, self.player, rng,
+                                      max_depth, moves, evaluate)
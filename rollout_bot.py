@@ -1,9 +1,59 @@
 import random
+from collections import OrderedDict
 
 ROLLOUTS = 10
 MAX_DEPTH = 5
 
 
+class MoveCache(object):
+    """ A bounded least-recently-used cache of per-move expectations by state, so that a position scored once is
+    not rolled out again. States are hashable (tuples, or ints for p3_t3.PackedBoard), so they key a dict directly.
+    """
+
+    def __init__(self, capacity=1 << 16):
+        """
+        Args:
+            capacity:   The number of states to keep. The least recently used one is dropped past that.
+
+        """
+        self.capacity = capacity
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, state):
+        """ Returns the (move, expectation) pairs stored for state, or None. """
+        entry = self.entries.get(state)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(state)
+        self.hits += 1
+        return entry
+
+    def put(self, state, entry):
+        self.entries[state] = entry
+        if len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+
+    def report(self, name):
+        print("%s cache: %d hits, %d misses (%.1f%% hits), %d states" % (
+            name, self.hits, self.misses, 100. * self.hits / max(self.hits + self.misses, 1), len(self.entries)))
+
+    def reset_counts(self):
+        """ Starts the hit and miss counts over, e.g. for a new game. The entries are kept. """
+        self.hits = 0
+        self.misses = 0
+
+
+def best_scored(scores):
+    """ Returns the (move, expectation) pair of scores with the highest expectation, the first one on ties. """
+    return max(scores, key=lambda score: score[1])
+
+
+cache = MoveCache()  # (move, expectation) of every legal move by state, kept for the whole run
+
+
 def think(board, state):
     """ For each possible move, this bot plays ROLLOUTS random games to depth MAX_DEPTH then averages the
     score as an estimate of how good the move is.
@@ -15,10 +65,14 @@ def think(board, state):
     Returns:    The action with the maximal score given the rollouts.
 
     """
-    moves = board.legal_actions(state)
+    scores = cache.get(state)
+    if scores is not None:
+        best_move, best_expectation = best_scored(scores)
+        print("Rollout bot picking %s with expected score %f (cached)" % (str(best_move), best_expectation))
+        return best_move
 
-    best_move = moves[0]
-    best_expectation = float('-inf')
+    moves = board.legal_actions(state)
+    scores = []
 
     me = board.current_player(state)
 
@@ -29,8 +83,7 @@ def think(board, state):
             red_score = game_points[1]*9
             blue_score = game_points[2]*9
         else:
-            red_score = len([v for v in owned_boxes.values() if v == 1])
-            blue_score = len([v for v in owned_boxes.values() if v == 2])
+            red_score, blue_score = owned_boxes
         return red_score - blue_score if me == 1 else blue_score - red_score
 
     for move in moves:
@@ -41,21 +94,14 @@ def think(board, state):
             rollout_state = board.next_state(state, move)
 
             # Only play to the specified depth.
-            for i in range(MAX_DEPTH):
-                if board.is_ended(rollout_state):
-                    break
-                rollout_move = random.choice(board.legal_actions(rollout_state))
-                rollout_state = board.next_state(rollout_state, rollout_move)
+            game_points, owned_boxes = board.playout(rollout_state, random, MAX_DEPTH)
 
-            total_score += outcome(board.owned_boxes(rollout_state),
-                                   board.points_values(rollout_state))
+            total_score += outcome(owned_boxes, game_points)
 
         expectation = float(total_score) / ROLLOUTS
+        scores.append((move, expectation))
 
-        # If the current move has a better average score, replace best_move and best_expectation
-        if expectation > best_expectation:
-            best_expectation = expectation
-            best_move = move
-
+    cache.put(state, scores)
+    best_move, best_expectation = best_scored(scores)
     print("Rollout bot picking %s with expected score %f" % (str(best_move), best_expectation))
     return best_move